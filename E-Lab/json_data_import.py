@@ -1,7 +1,11 @@
-import csv, json, os
+import csv, json, os, re
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
 
 def convert_csv_to_json(inputfile): 
-    """Read csv file, and convert to json string"""
+    """Read csv file, and convert to json string. For large files use iter_import_data"""
     data = []
     
     i = 0
@@ -11,12 +15,6 @@ def convert_csv_to_json(inputfile):
     
     return json.dumps(data)
 
-json0 = convert_csv_to_json(os.path.join(os.getcwd(),'data','V3CR_153523_20221115214820778_PAIRED_VISITS.csv'))
-json.loads(json0)[0]
-
-with open(os.path.join(os.getcwd(),'data','CONFIG_vineland3_table_qglobal_agcc.json')) as f: 
-    map0 = json.loads(f.read())
-
 # step 1: pull json for LORIS table
 
 # step 2: add array of import data., example below
@@ -117,8 +115,6 @@ def map_data_json_to_loris_json(lorismap, datarow):
     
     return {"Test_name": testname, "Date_taken": datetaken, "queryCommentID": queryCommentID, "queryUpdateFlag": queryUpdateFlag, "queryUpdateInstrument": queryUpdateInstrument}
 
-from datetime import datetime
-
 def get_query_to_populate_instrument_data(lorismap, datarow):
     
     map = lorismap[1:] # drop the first item in list, which is metadata. 
@@ -194,92 +190,383 @@ def pull_filters_from_loris_json(lorismap, datarow):
     # return { k: ('' if v is None else v) for k, v in filters.items() }
     return filters
 
-json0 = convert_csv_to_json(os.path.join(os.getcwd(),'data','V3CR_153523_20221115214820778.csv'))
-
-json.loads(json0)[0]["LastName"]
-
-map0[0]["Filters"]
-
-pull_filters_from_loris_json(map0, json.loads(json0)[0])
-test1 = map_data_json_to_loris_json(map0, json.loads(json0)[13])
-test00 = map_data_json_to_loris_json(map0, json.loads(json0)[0])
-
-# json.loads(json0)[15]['vi3_rec_']
-
-test1['queryCommentID']
-test1['queryUpdateFlag']
-test1['queryUpdateInstrument']
-
-test00['queryCommentID']
-test00['queryUpdateFlag']
-test00['queryUpdateInstrument']
-
-for x in json.loads(json0)[0:3]: 
-    print(x["LastName"])
-
-# import multiprocessing
-# from functools import partial
-
-# pool0 = multiprocessing.Pool()
-# map_partial = map_data_json_to_loris_json, lorismap = map0)
-# map_partial = lambda datarow : map_data_json_to_loris_json(map0, datarow)
-# pool0.map(lambda datarow : map_data_json_to_loris_json(map0, datarow), json.loads(json0))
-
-
-# loop through all data rows and get their queries
-data_queries = []
-for x in json.loads(json0): 
-    data_queries.append(map_data_json_to_loris_json(map0, x))
-    
-data_queries[0:1]
-
-# loop through all the queries. Run the select comment id, which we save a replace. 
-
-data_queries[0]["queryCommentID"]
-
-from db_connect import connect_to_database
-from db_connect import execute_select_commentid
-import re
-
-# Query Database with select_query_str
-db, dbcursor = connect_to_database(database = "redcap")
-prod, prodcursor = connect_to_database(database = "prod")
-
-
-
-query_results = []
-for x in data_queries:
-    tmp = x
-    #pull the comment ID 
-    select_query_result, commentid = execute_select_commentid(db, dbcursor, x["queryCommentID"])
-    tmp['CommentID Status'] = select_query_result
-    tmp['CommentID'] = commentid[0][0] if tmp['CommentID Status'] == 'y' else '' #returns a list of tuples. CommentID is the first value
-    
-    #try to update the flag table
-    if tmp['CommentID Status'] != 'y': 
-        tmp['UpdateFlag Status'] = 'n'
-        tmp['UpdateInstrument Status'] = 'n'
-    else: 
-        # replace queries with the found comment id
-        tmp['queryUpdateFlag'] = re.sub(r'REPLACE_CommentID', tmp["CommentID"], x['queryUpdateFlag'])
-        tmp['UpdateFlag Status'] = ''
-        tmp['queryUpdateInstrument'] = re.sub(r'REPLACE_CommentID', tmp["CommentID"], x['queryUpdateInstrument'])
-        tmp['UpdateInstrument Status'] = ''
-        # TODO: add routines to actually update prod here. 
-        # Use transactions so we can rollback if necessary
-        
-    query_results.append(tmp)
-
-        # print_line = "\t".join(
-        #     ["", row_id, date_taken, select_query_str, select_query_result, update_flag_str, "", update_inst_str])
-
-query_results[0].keys()
-headers = ['Test_name', 'Date_taken', 'queryCommentID', 'CommentID Status', 'CommentID', 'queryUpdateFlag', 'UpdateFlag Status', 'queryUpdateInstrument', 'UpdateInstrument Status']
-
-with open("vineland_transfer_tracker_2022-11-22.tsv", 'a') as output_file: 
-    dict_writer = csv.DictWriter(output_file, headers, delimiter='\t')
-    dict_writer.writeheader()
-    dict_writer.writerows(sorted(query_results, key = lambda x: x["CommentID Status"], reverse=True))
-    
-# CHECK?: NULLS need to be NULL not 'NULL' dodo
-# TODO: the percentile ranks had <1, which threw an INT error. I need to make a note in the instrument file/data export that 0 == <1 since you can't be the zeroth percentile. 
\ No newline at end of file
+# ============================================================================ #
+#                          compiled column mapping plan                        #
+# ============================================================================ #
+# format of "date" External Conversion values in the data export
+MAPPING_DATE_FORMAT = "%m/%d/%Y"
+# filter key columns added to the mapped data, see compile_commentid_filters
+FILTER_KEYS = {"candidate": "candidate", "visit": "visit", "date": "visit_date"}
+# column added to the mapped data with the values that could not be converted, "" when the row mapped cleanly
+MAPPING_ERROR = "Mapping Error"
+
+def compile_commentid_filters(lorismap):
+    """Read the Filters block once and return the SQL conditions for the candidate, visit and date keys.
+    Uses the same precedence as pull_filters_from_loris_json: the first PSCID filter, overridden by a CandID filter,
+    the first Visit_label filter, and the first Date filter.
+
+    Returns:
+        dict: key name ("candidate", "visit", "date") mapped to (SQL condition on k.<key>, filter config)
+    """
+    conditions = {}
+    for x in lorismap[0]['Filters']:
+        operator = sql_operator_conversion(x["Operator"])
+        if x["Field"] == "PSCID" and "candidate" not in conditions:
+            conditions["candidate"] = (f"c.PSCID {operator} k.candidate", x)
+        if x["Field"] == "CandID":
+            conditions["candidate"] = (f"c.CandID {operator} k.candidate", x)
+        if x["Field"] == "Visit_label" and "visit" not in conditions:
+            conditions["visit"] = (f"s.Visit_label {operator} k.visit", x)
+        if x["Field"] == "Date" and "date" not in conditions:
+            # FIXME: same condition as pull_filters_from_loris_json, which is probably wrong
+            conditions["date"] = ("ABS(DATEDIFF(s.Date_visit, k.visit_date)) > 40", x)
+    return conditions
+
+def compile_mapping_plan(lorismap):
+    """Read the CONFIG json once into a plan for apply_mapping_plan: which export columns map to which
+    instrument fields, their date conversion and NULL rule, and the filter key columns.
+
+    Returns:
+        dict: {"testname": str, "fields": [{"Field", "External Field", "date", "null"}], "filters": {key: {"External Field", "Fixed Value", "like"}}}
+    """
+    plan = {"testname": lorismap[0]['Test_name'], "fields": [], "filters": {}}
+    for x in lorismap[1:]:
+        if x["External Field"] is not None:
+            plan["fields"].append(
+                {
+                    "Field": x["Field"],
+                    "External Field": x["External Field"],
+                    "date": x["External Conversion"] == "date",
+                    "null": x["Null"] == "YES",
+                }
+            )
+    for key, (condition, config) in compile_commentid_filters(lorismap).items():
+        plan["filters"][key] = {
+            "External Field": config["External Field"],
+            "Fixed Value": config["Fixed Value"],
+            "like": str(sql_operator_conversion(config["Operator"])).find("LIKE") != -1,
+        }
+    return plan
+
+def apply_mapping_plan(plan, data, columns=None, date_format=MAPPING_DATE_FORMAT):
+    """Map a whole data export at once, with the same rules as get_query_to_populate_instrument_data and pull_filters_from_loris_json.
+
+    Args:
+        plan (dict): from compile_mapping_plan
+        data (DataFrame): the data export, one row per data row. Values are read as text
+        columns (list): only map these output columns. All columns when None
+        date_format (str): format of the "date" conversion columns
+
+    Returns:
+        DataFrame: with the same index as `data`, the filter key columns (candidate, visit, visit_date; with a trailing % for LIKE filters,
+            None when the CONFIG has no such filter) followed by one column per mapped instrument field. Empty values are None (NULL)
+            for fields that allow NULL, dates are formatted as YYYY-MM-DD. A last MAPPING_ERROR column lists the dates that
+            did not match `date_format`, which are mapped to None instead of raising.
+    """
+    mapped = pd.DataFrame(index=data.index)
+    if data.empty:
+        outputs = list(FILTER_KEYS.values()) + [x["Field"] for x in plan["fields"]]
+        return pd.DataFrame(columns=[x for x in outputs if columns is None or x in columns] + [MAPPING_ERROR], index=data.index, dtype=object)
+    errors = pd.Series("", index=data.index, dtype=object)
+    for key, column in FILTER_KEYS.items():
+        if columns is not None and column not in columns:
+            continue
+        if key not in plan["filters"]:
+            mapped[column] = None
+            continue
+        x = plan["filters"][key]
+        values = data[x["External Field"]].fillna("").astype(str) if (x["Fixed Value"] == None) else pd.Series(str(x["Fixed Value"]), index=data.index)
+        mapped[column] = (values + "%" if x["like"] else values).astype(object)
+
+    for x in plan["fields"]:
+        if columns is not None and x["Field"] not in columns:
+            continue
+        values = data[x["External Field"]].fillna("").astype(str).astype(object)
+        empty = values == ""
+        if x["date"] and (~empty).any():
+            dates = pd.to_datetime(values[~empty], format=date_format, errors="coerce")
+            for i in dates.index[dates.isna()]:
+                errors[i] += f"{'; ' if errors[i] else ''}{x['External Field']} '{values[i]}' is not a {date_format} date"
+            values[~empty] = dates.dt.strftime("%Y-%m-%d").astype(object).where(dates.notna(), None)
+            empty = values.isna() | (values == "")
+        mapped[x["Field"]] = values.where(~empty, None) if x["null"] else values
+    mapped[MAPPING_ERROR] = errors
+    return mapped
+
+def map_import_data(lorismap, data, columns=None):
+    """Compile the CONFIG json and apply it to `data`, a DataFrame or a list of data row dictionaries. See apply_mapping_plan"""
+    if not isinstance(data, pd.DataFrame):
+        data = pd.DataFrame(list(data))
+    return apply_mapping_plan(compile_mapping_plan(lorismap), data, columns=columns)
+
+# ============================================================================ #
+#                          bulk CommentID resolution                           #
+# ============================================================================ #
+# number of data rows resolved by one SELECT
+COMMENTID_BATCH_SIZE = 1000
+
+def resolve_commentids(cnx, lorismap, datarows, batch_size=COMMENTID_BATCH_SIZE, mapped=None):
+    """Find the CommentID of every data row with one SELECT per batch of rows, instead of one query per row.
+
+    The filter keys of a batch are sent as a derived table (SELECT ... UNION ALL SELECT ...) and joined to
+    candidate, session, flag and the instrument table, so no temporary table privileges are needed.
+
+    Args:
+        cnx: open DB-API connection (mysql.connector or sqlite3)
+        lorismap (list): CONFIG json for the instrument, the first item has Test_name and Filters
+        datarows (list or DataFrame): data rows as dictionaries, i.e. json.loads(convert_csv_to_json(...)), or the data export DataFrame
+        batch_size (int): number of rows resolved by each SELECT
+        mapped (DataFrame): `datarows` already mapped with apply_mapping_plan. Mapped here when None
+
+    Returns:
+        tuple: (commentids, unresolved) DataFrames indexed by data row, with the filter keys, CommentID,
+            number of matches and CommentID Status ('y' one match, 'n' no match, 'm' ambiguous).
+            unresolved has only the 'n' and 'm' rows.
+    """
+    testname = lorismap[0]['Test_name']
+    conditions = compile_commentid_filters(lorismap)
+    placeholder = "?" if isinstance(cnx, sqlite3.Connection) else "%s"
+
+    # filter keys for every row, None where the CONFIG has no such filter
+    if mapped is None:
+        mapped = map_import_data(lorismap, datarows, columns=list(FILTER_KEYS.values()))
+    commentids = mapped[list(FILTER_KEYS.values())]
+    rowids = [int(i) for i in commentids.index]
+    keyrows = commentids.values.tolist()
+
+    where = " ".join(f"AND {conditions[key][0]} " for key in FILTER_KEYS if key in conditions)
+    matches = []
+    cursor = cnx.cursor()
+    try:
+        for start in range(0, len(keyrows), batch_size):
+            batch = keyrows[start:start + batch_size]
+            derived = " UNION ALL ".join(
+                [f"SELECT {placeholder} AS row_id, {placeholder} AS candidate, {placeholder} AS visit, {placeholder} AS visit_date"]
+                * len(batch)
+            )
+            statement = (
+                "SELECT k.row_id, f.CommentID "
+                f"FROM ({derived}) AS k, session AS s "
+                "JOIN candidate AS c ON c.CandID = s.CandID "
+                "JOIN flag AS f ON s.ID = f.SessionID "
+                f"JOIN {testname} AS instrument ON instrument.CommentID = f.CommentID "
+                "WHERE f.CommentID NOT LIKE 'DDE%' "
+                f"AND f.Test_name = {placeholder} "
+                f"{where}"
+            )
+            parameters = [value for i, row in zip(rowids[start:start + batch_size], batch) for value in [i] + row]
+            cursor.execute(statement, parameters + [testname])
+            matches.extend(cursor.fetchall())
+    finally:
+        cursor.close()
+
+    commentids = commentids.copy()
+    found = pd.DataFrame(matches, columns=["row", "CommentID"]).drop_duplicates()
+    counts = found.groupby("row")["CommentID"].agg(["first", "size"])
+    commentids["matches"] = counts["size"].reindex(commentids.index, fill_value=0).astype(int)
+    commentids["CommentID"] = counts["first"].reindex(commentids.index).where(commentids["matches"] == 1, "")
+    commentids["CommentID Status"] = commentids["matches"].map(lambda n: "y" if n == 1 else ("n" if n == 0 else "m"))
+
+    unresolved = commentids[commentids["CommentID Status"] != "y"]
+    return commentids, unresolved
+
+# ============================================================================ #
+#                        batched instrument data updates                       #
+# ============================================================================ #
+# number of rows updated by one executemany call and transaction
+UPDATE_BATCH_SIZE = 500
+
+def compile_update_statements(lorismap, placeholder="%s"):
+    """Prepared UPDATE statements for the instrument and flag tables, with one placeholder per mapped column.
+
+    Returns:
+        tuple: (instrument UPDATE, flag UPDATE, instrument columns in parameter order).
+            The instrument parameters are the column values followed by the CommentID, the flag parameters are (Test_name, CommentID)
+    """
+    testname = lorismap[0]['Test_name']
+    columns = [x["Field"] for x in lorismap[1:] if x["External Field"] is not None]
+    assignments = ", ".join(f"`{column}` = {placeholder}" for column in columns)
+    queryUpdateInstrument = (
+        f"UPDATE `{testname}` "
+        "SET Data_entry_completion_status = 'Complete', examiner = 54"
+        + (f", {assignments} " if columns else " ")
+        + "WHERE Date_taken IS NULL " #only update rows with no existing data
+        f"AND CommentID = {placeholder}"
+    )
+    queryUpdateFlag = (
+        "UPDATE flag SET Data_entry = 'Complete', Administration = 'All' "
+        f"WHERE test_name = {placeholder} "
+        f"AND CommentID = {placeholder}"
+    )
+    return queryUpdateInstrument, queryUpdateFlag, columns
+
+def execute_instrument_updates(cnx, lorismap, datarows, commentids, batch_size=UPDATE_BATCH_SIZE, dry_run=False, mapped=None, seen=None):
+    """Update the instrument and flag tables for every resolved data row with prepared statements and executemany.
+
+    Each batch runs in one transaction. Rows whose instrument already has a Date_taken are skipped, and only the first row for a CommentID is applied.
+    Rows with a MAPPING_ERROR (a date that could not be converted) are reported as failed and not applied.
+    If a batch fails it is rolled back, and its rows are retried one at a time so only the failing rows are left out.
+
+    Args:
+        cnx: open DB-API connection (mysql.connector or sqlite3) to the LORIS database
+        lorismap (list): CONFIG json for the instrument
+        datarows (list or DataFrame): data rows, the same passed to resolve_commentids
+        commentids (DataFrame): from resolve_commentids
+        batch_size (int): rows per executemany call and transaction
+        dry_run (bool): run every update, then roll it back
+        mapped (DataFrame): `datarows` already mapped with apply_mapping_plan. Mapped here when None
+        seen (dict): CommentIDs already applied, mapped to their row. Pass the same dict for every chunk of one export
+
+    Returns:
+        DataFrame: per row CommentID, Update Status ("updated", "skipped", "duplicate", "unresolved", "failed" or "dry-run") and Update Error
+    """
+    testname = lorismap[0]['Test_name']
+    placeholder = "?" if isinstance(cnx, sqlite3.Connection) else "%s"
+    queryUpdateInstrument, queryUpdateFlag, columns = compile_update_statements(lorismap, placeholder)
+
+    # values for every row, mapped once from the whole data export
+    if mapped is None:
+        mapped = map_import_data(lorismap, datarows, columns=columns)
+    errors = mapped[MAPPING_ERROR]
+    mapped = mapped[columns]
+    status = pd.DataFrame({"CommentID": commentids["CommentID"], "Update Status": "unresolved", "Update Error": ""})
+    resolved = [i for i in commentids.index if commentids.at[i, "CommentID Status"] == "y"]
+    # first row for each CommentID, later rows for the same instrument are not applied
+    seen = seen if seen is not None else {}
+
+    def run(cursor, rows):
+        cursor.executemany(queryUpdateInstrument, [row[1] for row in rows])
+        cursor.executemany(queryUpdateFlag, [(testname, row[1][-1]) for row in rows])
+        if dry_run:
+            cnx.rollback()
+        else:
+            cnx.commit()
+
+    cursor = cnx.cursor()
+    try:
+        for start in range(0, len(resolved), batch_size):
+            batch = resolved[start:start + batch_size]
+            # skip instruments that already have data, which the WHERE clause would not update
+            batchids = [commentids.at[i, "CommentID"] for i in batch]
+            cursor.execute(
+                f"SELECT CommentID FROM `{testname}` WHERE Date_taken IS NOT NULL "
+                f"AND CommentID IN ({', '.join([placeholder] * len(batchids))})",
+                batchids,
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            rows = []
+            for i in batch:
+                if errors[i]:
+                    status.at[i, "Update Status"] = "failed"
+                    status.at[i, "Update Error"] = errors[i]
+                    continue
+                if commentids.at[i, "CommentID"] in existing:
+                    status.at[i, "Update Status"] = "skipped"
+                    continue
+                if commentids.at[i, "CommentID"] in seen:
+                    status.at[i, "Update Status"] = "duplicate"
+                    status.at[i, "Update Error"] = f"same CommentID as row {seen[commentids.at[i, 'CommentID']]}"
+                    continue
+                seen[commentids.at[i, "CommentID"]] = i
+                rows.append((i, mapped.loc[i].tolist() + [commentids.at[i, "CommentID"]]))
+
+            try:
+                run(cursor, rows)
+                status.loc[[i for i, _ in rows], "Update Status"] = "dry-run" if dry_run else "updated"
+            except Exception:
+                cnx.rollback()
+                # find the failing rows, committing the others one at a time
+                for row in rows:
+                    try:
+                        run(cursor, [row])
+                        status.at[row[0], "Update Status"] = "dry-run" if dry_run else "updated"
+                    except Exception as err:
+                        cnx.rollback()
+                        status.at[row[0], "Update Status"] = "failed"
+                        status.at[row[0], "Update Error"] = str(err)
+    finally:
+        cursor.close()
+
+    return status
+
+# ============================================================================ #
+#                          streaming data export ingestion                     #
+# ============================================================================ #
+# rows read from the data export at a time
+IMPORT_CHUNKSIZE = 5000
+
+def iter_import_data(inputfile, chunksize=None, lorismap=None):
+    """Read a data export csv without loading the whole file, instead of convert_csv_to_json.
+
+    Args:
+        inputfile (str): path to the data export csv
+        chunksize (int): yield DataFrame chunks of this many rows. Yields one dictionary per row when None
+        lorismap (list): CONFIG json. When given, rows are mapped with apply_mapping_plan (filter keys, NULLs and converted dates)
+
+    Yields:
+        dict or DataFrame: one data row, or one chunk. Chunks keep the row number in the file as their index
+    """
+    if lorismap is None and chunksize is None:
+        with open(inputfile, newline='') as f:
+            yield from csv.DictReader(f)
+        return
+
+    plan = compile_mapping_plan(lorismap) if lorismap is not None else None
+    # read every column as text, like csv.DictReader
+    chunks = pd.read_csv(inputfile, dtype=str, keep_default_na=False, chunksize=chunksize or IMPORT_CHUNKSIZE)
+    for chunk in chunks:
+        if plan is not None:
+            chunk = apply_mapping_plan(plan, chunk)
+        if chunksize is None:
+            yield from chunk.to_dict(orient='records')
+        else:
+            yield chunk
+
+def import_data_export(cnx, prodcnx, lorismap, inputfile, chunksize=IMPORT_CHUNKSIZE, dry_run=False):
+    """Import a data export into LORIS one chunk at a time: resolve the CommentIDs, then update the instrument and flag tables.
+    Only one chunk of the file is held in memory.
+
+    Args:
+        cnx: connection used to find CommentIDs, see resolve_commentids
+        prodcnx: connection to the LORIS database that is updated, see execute_instrument_updates
+        lorismap (list): CONFIG json for the instrument
+        inputfile (str): path to the data export csv
+        chunksize (int): rows per chunk
+        dry_run (bool): roll back every update
+
+    Yields:
+        DataFrame: per row of the chunk (indexed by row number in the file) the filter keys, CommentID, CommentID Status, Update Status and Update Error
+    """
+    plan = compile_mapping_plan(lorismap)
+    # CommentIDs applied by earlier chunks, so duplicates are found across chunk boundaries
+    seen = {}
+    for chunk in iter_import_data(inputfile, chunksize=chunksize):
+        mapped = apply_mapping_plan(plan, chunk)
+        commentids, _ = resolve_commentids(cnx, lorismap, chunk, mapped=mapped)
+        updates = execute_instrument_updates(prodcnx, lorismap, chunk, commentids, dry_run=dry_run, mapped=mapped, seen=seen)
+        yield commentids.join(updates[["Update Status", "Update Error"]])
+
+if __name__ == "__main__":
+    from db_connect import connect_to_database
+
+    inputfile = os.path.join(os.getcwd(),'data','V3CR_153523_20221115214820778.csv')
+    with open(os.path.join(os.getcwd(),'data','CONFIG_vineland3_table_qglobal_agcc.json')) as f: 
+        map0 = json.loads(f.read())
+
+    # print the queries generated for the first row, to check the CONFIG mapping
+    test00 = map_data_json_to_loris_json(map0, next(iter_import_data(inputfile)))
+    print(test00['queryCommentID'])
+    print(test00['queryUpdateFlag'])
+    print(test00['queryUpdateInstrument'])
+
+    # Query Database with select_query_str
+    db, dbcursor = connect_to_database(database = "redcap")
+    prod, prodcursor = connect_to_database(database = "prod")
+
+    # stream the export through CommentID resolution and the prod updates, writing the tracker as each chunk finishes
+    with open("vineland_transfer_tracker_2022-11-22.tsv", 'a') as output_file: 
+        for n, results in enumerate(import_data_export(db, prod, map0, inputfile)):
+            results.to_csv(output_file, sep='\t', header=(n == 0), index_label='row')
+            print(results["Update Status"].value_counts())
+
+    # TODO: the percentile ranks had <1, which threw an INT error. I need to make a note in the instrument file/data export that 0 == <1 since you can't be the zeroth percentile. 
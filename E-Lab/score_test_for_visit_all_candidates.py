@@ -1,8 +1,9 @@
 from logging import raiseExceptions
 import os
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
-import mysql.connector
 import re
 import argparse
 
@@ -14,8 +15,16 @@ Since this script can score (1) all instruments (2) all for a single instrument
 this script acts as a wrapper for looping through a list of participants. 
 """
 
+# command that scores one instrument for one candidate/visit, followed by: {test} one {candidateID} {sessionID}
+SCORE_INSTRUMENT_COMMAND = ["php", "../data_integrity/score_instrument.php"]
+# number of score_instrument.php processes run at the same time
+SCORE_JOBS = 4
+
 
 def connect_server():
+    # imported here, so scoring a candidate list works without the database driver
+    import mysql.connector
+
     mydb = mysql.connector.connect(
         host="loris.ahc.umn.edu",
         database="icd",
@@ -27,6 +36,8 @@ def connect_server():
 
 
 def execute_select(mydb, mycursor, statement):
+    import mysql.connector
+
     # Init
     comment = ""
     # Check if statement is a select statement
@@ -82,48 +93,104 @@ def get_list_candidateID_sessionID_for_visit(visit_label):
         return myresult
 
 
-def score_one_test_for_one_candidate_visit(test_i, candidateID_i, sessionID_i):
+def score_one_test_for_one_candidate_visit(
+    test_i, candidateID_i, sessionID_i, command=SCORE_INSTRUMENT_COMMAND, timeout=None
+):
+    """Run score_instrument.php for one candidate/visit, and return the exit code and output
+
+    Returns:
+        dict: one row of the results table (returncode, status, stdout, stderr and seconds)
+    """
+    args = list(command) + [str(test_i), "one", str(candidateID_i), str(sessionID_i)]
+    start = time.perf_counter()
     try:
-        # subprocess.run(
-        #     "php /swadm/var/www/elab-loris/tools/data_integrity/score_instrument.php {test} one {candidateID} {sessionID}".format(
-        #         test=test_i, candidateID=candidateID_i, sessionID=sessionID_i
-        #     ),
-        #     check=True,
-        # )
-        process = subprocess.Popen(
-            # ["php", "/swadm/var/www/elab-loris/tools/data_integrity/score_instrument.php", test_i, "one", candidateID_i, sessionID_i]
-            # "php /swadm/var/www/elab-loris/tools/data_integrity/score_instrument.php {test} one {candidateID} {sessionID}".format(
-            "php ../data_integrity/score_instrument.php {test} one {candidateID} {sessionID}".format(
-                test=test_i, candidateID=candidateID_i, sessionID=sessionID_i
-            ),
-            shell=True, 
-            stdout=subprocess.PIPE
-        )
-        response = process.stdout.read()
-        print(response)
-
-    except subprocess.CalledProcessError:
-        print("command does not exist")
-    # os.system(
-    #     "php /swadm/var/www/elab-loris/tools/data_integrity/score_instrument.php {test} one {candidateID} {sessionID}".format(
-    #         test=test_i, candidateID=candidateID_i, sessionID=sessionID_i
-    #     )
-    # )
-
-
-def score_test_for_candidate_list(test, candidate_list):
-
-    for i, x in candidate_list.iterrows():
-        print(
-            "====> Scoring instrument {test} ({i} of {N}): for \tCandidateID {candidateID}\tsessionID {sessionID}".format(
-                test=test,
-                i="{:4}".format(i + 1),
-                N="{:4}".format(len(candidate_list)),
-                candidateID=x["candidateID"],
-                sessionID=x["sessionID"],
+        process = subprocess.run(args, capture_output=True, text=True, timeout=timeout)
+        returncode, stdout, stderr = process.returncode, process.stdout, process.stderr
+        status = "scored" if returncode == 0 else "failed"
+    except subprocess.TimeoutExpired as err:
+        returncode, stdout, stderr = None, err.stdout or "", err.stderr or ""
+        status = "timeout"
+    except OSError as err:
+        # the scorer (or php) could not be started
+        returncode, stdout, stderr = None, "", str(err)
+        status = "failed"
+
+    return {
+        "test": test_i,
+        "candidateID": candidateID_i,
+        "sessionID": sessionID_i,
+        "command": " ".join(args),
+        "returncode": returncode,
+        "status": status,
+        "stdout": stdout.decode() if isinstance(stdout, bytes) else stdout,
+        "stderr": stderr.decode() if isinstance(stderr, bytes) else stderr,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def score_test_for_candidate_list(
+    test,
+    candidate_list,
+    jobs=SCORE_JOBS,
+    command=SCORE_INSTRUMENT_COMMAND,
+    timeout=None,
+    dry_run=False,
+):
+    """Score `test` for every candidate/session in `candidate_list`, running up to `jobs` scorer processes at the same time
+
+    Args:
+        test (str): name of the instrument to score
+        candidate_list (DataFrame): candidateID and sessionID columns, see get_list_candidateID_sessionID_for_visit
+        jobs (int): maximum number of score_instrument.php processes running at the same time
+        command (list): scorer command, the test, "one", candidateID and sessionID are appended
+        timeout (float): seconds before one scorer process is stopped. None waits until it finishes
+        dry_run (bool): only list the commands that would run
+
+    Returns:
+        DataFrame: one row per candidate/session with the command, exit code, status, stdout and stderr, in candidate_list order
+    """
+    candidates = list(zip(candidate_list["candidateID"], candidate_list["sessionID"]))
+    N = len(candidates)
+
+    if dry_run:
+        results = []
+        for candidateID, sessionID in candidates:
+            args = list(command) + [str(test), "one", str(candidateID), str(sessionID)]
+            print(" ".join(args))
+            results.append(
+                {
+                    "test": test,
+                    "candidateID": candidateID,
+                    "sessionID": sessionID,
+                    "command": " ".join(args),
+                    "status": "dry-run",
+                }
             )
-        )
-        score_one_test_for_one_candidate_visit(test, x["candidateID"], x["sessionID"])
+        return pd.DataFrame(results)
+
+    results = [None] * N
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        future_to_index = {
+            executor.submit(
+                score_one_test_for_one_candidate_visit, test, candidateID, sessionID, command, timeout
+            ): i
+            for i, (candidateID, sessionID) in enumerate(candidates)
+        }
+        for ndone, future in enumerate(as_completed(future_to_index)):
+            result = future.result()
+            results[future_to_index[future]] = result
+            print(
+                "====> Scored instrument {test} ({i} of {N}): for \tCandidateID {candidateID}\tsessionID {sessionID}\t{status}".format(
+                    test=test,
+                    i="{:4}".format(ndone + 1),
+                    N="{:4}".format(N),
+                    candidateID=result["candidateID"],
+                    sessionID=result["sessionID"],
+                    status=result["status"],
+                )
+            )
+
+    return pd.DataFrame(results)
 
 
 # def run_test(test, visit):
@@ -132,9 +199,17 @@ def score_test_for_candidate_list(test, candidate_list):
 #     return 0
 
 
-def get_visit_list_and_score_test(visit, test):
+def get_visit_list_and_score_test(visit, test, jobs=SCORE_JOBS, results_file=None, **kwargs):
     mylist = get_list_candidateID_sessionID_for_visit(visit)
-    score_test_for_candidate_list(test, mylist)
+    results = score_test_for_candidate_list(test, mylist, jobs=jobs, **kwargs)
+    # a dry run only lists the commands, so there are no results to keep
+    if results_file is not None and not kwargs.get("dry_run"):
+        results.to_csv(results_file, index=False)
+        print(f"Results for {len(results)} candidates written to {results_file}")
+    if "returncode" in results:
+        nfailed = int((results["status"] != "scored").sum())
+        print(f"Scored {len(results) - nfailed} of {len(results)}, {nfailed} failed")
+    return results
 
 
 if __name__ == "__main__":
@@ -158,13 +233,52 @@ if __name__ == "__main__":
         help="name of visit you want to score",
         required=True,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=SCORE_JOBS,
+        help=f"number of score_instrument.php processes to run at the same time. Defaults to {SCORE_JOBS}",
+    )
+    parser.add_argument(
+        "--results",
+        dest="results",
+        type=str,
+        default=None,
+        help="csv file for the results table (exit code, status, stdout and stderr per candidate). Defaults to score_<test>_<visit>_results.csv",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=None,
+        help="seconds before one score_instrument.php process is stopped",
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="print the score_instrument.php commands without running them",
+    )
     args = parser.parse_args()
 
     # if args.test.isalnum() and args.visit.isalnum():
     if re.match(r"^[A-Za-z0-9_]+$", args.test) and re.match(
         r"^[A-Za-z0-9_]+$", args.visit
     ):
-        get_visit_list_and_score_test(args.visit, args.test)
+        get_visit_list_and_score_test(
+            args.visit,
+            args.test,
+            jobs=args.jobs,
+            results_file=(
+                args.results
+                if args.results != None
+                else f"score_{args.test}_{args.visit}_results.csv"
+            ),
+            timeout=args.timeout,
+            dry_run=args.dry_run,
+        )
     else:
         raise Exception(
             "specify the test and visit like:\n\n\tpython score_test_for_visit_all_candidates.py --test <test_name> --visit <visit_label>\n"
@@ -1,12 +1,53 @@
 import os
 import re
 import json
+import threading
 from datetime import datetime
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 # import jinja2
 # from flask import render_template
 
+# ============================================================================ #
+#                           compiled template registry                         #
+# ============================================================================ #
+# default templates directory is next to this file, so scripts can be run from any directory
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+# one jinja2 Environment per templates directory, and one compiled template per (directory, name)
+_template_environments = {}
+_compiled_templates = {}
+_template_lock = threading.Lock()
+
+
+def get_template_environment(templates_dir=None):
+    """Return the shared jinja2 Environment for a templates directory.
+    Compiled templates are also written to a bytecode cache in the system temp directory,
+    so later runs skip parsing templates that have not changed.
+    """
+    templates_dir = os.path.abspath(templates_dir or TEMPLATES_DIR)
+    with _template_lock:
+        if templates_dir not in _template_environments:
+            _template_environments[templates_dir] = Environment(
+                loader=FileSystemLoader(templates_dir),
+                bytecode_cache=FileSystemBytecodeCache(),
+                trim_blocks=True,
+                lstrip_blocks=True,
+            )
+        return _template_environments[templates_dir]
+
+
+def get_template(name, templates_dir=None):
+    """Return the compiled jinja2 Template `name`, parsing it only the first time it is requested."""
+    templates_dir = os.path.abspath(templates_dir or TEMPLATES_DIR)
+    key = (templates_dir, name)
+    if key not in _compiled_templates:
+        template = get_template_environment(templates_dir).get_template(name)
+        with _template_lock:
+            _compiled_templates.setdefault(key, template)
+    return _compiled_templates[key]
+
+
 
 def clean_strings_for_php(input: str):
     """Clean double quotation marks from string for php
@@ -15,6 +56,67 @@ def clean_strings_for_php(input: str):
     return re.sub("\n", "<br/>", re.sub('"', '"', input))
 
 
+# ============================================================================ #
+#                        SQL data type to PHP element type                     #
+# ============================================================================ #
+# PHP (LORIS form) element types and the SQL data types displayed with them
+FIELD_TYPES = {
+    "text": [
+        "varchar",
+        "int",
+        "char",
+        "tinyint",
+        "smallint",
+        "mediumint",
+        "bigint",
+        "decimal",
+        "dec",
+        "float",
+        "double",
+        "tinytext",
+    ],
+    "textarea": ["text", "mediumtext", "longtext"],
+    "select": ["enum"],
+    "date": ["date"],
+}
+
+# precomputed reverse lookup, i.e. {"varchar": "text", "longtext": "textarea", "enum": "select", ...}
+SQL_TO_PHP_FIELD_TYPE = {
+    sql_type: php_type
+    for php_type, sql_types in FIELD_TYPES.items()
+    for sql_type in sql_types
+}
+
+
+def normalize_sql_type(field_type_sql):
+    """Reduce a SQL column type to its base type, i.e. 'varchar(255)' -> 'varchar', 'DECIMAL(5,2)' -> 'decimal', 'int unsigned' -> 'int'"""
+    match = re.match(r"\s*([a-zA-Z]+)", str(field_type_sql or ""))
+    return match.group(1).lower() if match else ""
+
+
+def sql_to_php_field_type(field_type_sql, default="static"):
+    """Return the PHP element type (text, textarea, select or date) used to display a SQL column type.
+    Types that are not SQL data types (i.e. header, static, score) return `default`.
+    """
+    return SQL_TO_PHP_FIELD_TYPE.get(normalize_sql_type(field_type_sql), default)
+
+
+def index_fields_by_group(fields, groups):
+    """Map each group name to the (key, field) pairs listed in its `group_fields`, in the order of `fields`.
+    Group membership is indexed by `field_name_sql` once, so resolving every group is linear in the template size.
+    """
+    groups_by_field_name = {}
+    for g, group in groups.items():
+        for field_name in set(group.get("group_fields") or []):
+            groups_by_field_name.setdefault(field_name, []).append(g)
+
+    fields_by_group = {g: [] for g in groups.keys()}
+    for key, value in fields.items():
+        for g in groups_by_field_name.get(value["field_name_sql"], []):
+            fields_by_group[g].append((key, value))
+    return fields_by_group
+
+
 def convert_instrument_template(instrument_information, **kwargs):
     """
     create_instrument_php:
@@ -24,25 +126,7 @@ def convert_instrument_template(instrument_information, **kwargs):
     kwargs:
     """
 
-    field_type = {
-        "text": [
-            "varchar",
-            "int",
-            "char",
-            "tinyint",
-            "smallint",
-            "mediumint",
-            "bigint",
-            "decimal",
-            "dec",
-            "float",
-            "double",
-            "tinytext",
-        ],
-        "textarea": ["text", "mediumtext", "longtext"],
-        "select": ["enum"],
-        "date": ["date"],
-    }
+    field_type = FIELD_TYPES
 
     # convert to dictionary of instrument parameters
     # instrument_information = json.load(instrument_json)
@@ -163,13 +247,16 @@ def convert_instrument_template(instrument_information, **kwargs):
     # ------------------------- parse group data, if any ------------------------- #
     ngroups = 0
     if "groups" in instrument_information.keys():
+        fields_by_group = index_fields_by_group(
+            instrument_information.get("fields", {}), instrument_information["groups"]
+        )
         for g in instrument_information["groups"].keys():
             tmp_g = {}
             ngroups += 1
             for param in json_keys_group_parameters:
                 # if we are on the group_fields, we grab all the keys from "fields" for easy access
                 if param == "group_fields":
-                    # grab dict keys from instrument["fields"]
+                    # grab dict keys from instrument["fields"], using the index built above
                     tmp_g["group_fields_keys"] = [
                         {
                             "key": key,
@@ -177,14 +264,7 @@ def convert_instrument_template(instrument_information, **kwargs):
                             "label": value.get(
                                 "field_front_text_php", value["field_name_sql"]
                             ),
-                            "type": [
-                                x
-                                for x in [
-                                    k if (value["field_type_sql"] in v) else None
-                                    for k, v in field_type.items()
-                                ]
-                                if x is not None
-                            ][0],
+                            "type": sql_to_php_field_type(value["field_type_sql"]),
                             # TODO: add these parameters to template
                             # "attributes": None,
                             "options": (
@@ -208,9 +288,7 @@ def convert_instrument_template(instrument_information, **kwargs):
                             # }
                             # "customs": None
                         }
-                        for key, value in instrument_information["fields"].items()
-                        if value["field_name_sql"]
-                        in instrument_information["groups"][g]["group_fields"]
+                        for key, value in fields_by_group[g]
                     ]
                     # grab php text for the keys
                     # tmp_g["group_fields_text"] = [value.get("field_front_text_php", value["field_name_sql"]) for key, value in instrument_information["fields"].items() if value["field_name_sql"] in instrument_information["groups"][g]["group_fields"]]
@@ -398,6 +476,11 @@ def convert_instrument_template(instrument_information, **kwargs):
                 # then we save those parameters to the array
                 field_parameters[q] = tmp_q
 
+            # PHP element type used by the template, None for non-SQL types (header, static, br, score)
+            tmp_q["field_type_php"] = sql_to_php_field_type(
+                tmp_q["field_type_sql"], default=None
+            )
+
     else:
         raise OSError(
             "Instrument Template file doesn't have any fields, or they are incorrectly labelled. Should be 'fields': \{\}"
@@ -423,16 +506,13 @@ def convert_instrument_template(instrument_information, **kwargs):
     return template_parameters
 
 
-def generate_instrument_sql(instrument_data):
+def generate_instrument_sql(instrument_data, templates_dir=None):
 
     # ----------------------- INSERT into test_names table ----------------------- #
-    with open(
-        "templates/LORIS_INSERT_test_names_template.sql.jinja2"
-    ) as filein:  # noqa
-        test_names_template = Template(
-            filein.read(), trim_blocks=True, lstrip_blocks=True
-        )
-        # TODO: add support for instrument subgroup input
+    test_names_template = get_template(
+        "LORIS_INSERT_test_names_template.sql.jinja2", templates_dir
+    )
+    # TODO: add support for instrument subgroup input
 
     with open(
         "outputs/sql/test_names_INSERT_"
@@ -451,12 +531,9 @@ def generate_instrument_sql(instrument_data):
     #     output.write(test_names_template.render(instrument_data))
 
     # --------------------- INSERT into test_subgroups table --------------------- #
-    with open(
-        "templates/LORIS_INSERT_instrument_subtests_template.sql.jinja2"
-    ) as filein:  # noqa
-        instrument_subtest_template = Template(
-            filein.read(), trim_blocks=True, lstrip_blocks=True
-        )
+    instrument_subtest_template = get_template(
+        "LORIS_INSERT_instrument_subtests_template.sql.jinja2", templates_dir
+    )
 
     with open(
         "outputs/sql/instrument_subtests_INSERT_"
@@ -469,12 +546,12 @@ def generate_instrument_sql(instrument_data):
     # ---------------------- INSERT into test_battery table ---------------------- #
 
 
-def generate_instrument_from_template(instrument_json, output_dir):
+def generate_instrument_from_template(instrument_json, output_dir, templates_dir=None):
     """
     read_instrument_template:
 
     kwargs:
-
+        templates_dir (str): directory with the jinja2 templates. Defaults to TEMPLATES_DIR
     """
     cwd = os.getcwd()
     # TODO: update this function to add folders if they don't exist in the current working directory.
@@ -499,12 +576,9 @@ def generate_instrument_from_template(instrument_json, output_dir):
     # ============================================================================ #
     # generate_instrument_sql(inst)
     # -------------------------- CREATE instrument table ------------------------- #
-    with open(
-        "templates/LORIS_CREATE_instrument_table_template.sql.jinja2"
-    ) as filein:  # noqa
-        create_table_template = Template(
-            filein.read(), trim_blocks=True, lstrip_blocks=True
-        )
+    create_table_template = get_template(
+        "LORIS_CREATE_instrument_table_template.sql.jinja2", templates_dir
+    )
 
     with open(
         os.path.join(
@@ -517,13 +591,10 @@ def generate_instrument_from_template(instrument_json, output_dir):
         output.write(create_table_template.render(inst))
 
     # ----------------------- INSERT into test_names table ----------------------- #
-    with open(
-        "templates/LORIS_INSERT_test_names_template.sql.jinja2"
-    ) as filein:  # noqa
-        test_names_template = Template(
-            filein.read(), trim_blocks=True, lstrip_blocks=True
-        )
-        # TODO: add support for instrument subgroup input
+    test_names_template = get_template(
+        "LORIS_INSERT_test_names_template.sql.jinja2", templates_dir
+    )
+    # TODO: add support for instrument subgroup input
 
     with open(
         os.path.join(
@@ -536,12 +607,9 @@ def generate_instrument_from_template(instrument_json, output_dir):
         output.write(test_names_template.render(inst))
 
     #  --------------------- INSERT into test_subgroups table --------------------- #
-    with open(
-        "templates/LORIS_INSERT_instrument_subtests_template.sql.jinja2"
-    ) as filein:  # noqa
-        instrument_subtest_template = Template(
-            filein.read(), trim_blocks=True, lstrip_blocks=True
-        )
+    instrument_subtest_template = get_template(
+        "LORIS_INSERT_instrument_subtests_template.sql.jinja2", templates_dir
+    )
 
     with open(
         os.path.join(
@@ -559,8 +627,9 @@ def generate_instrument_from_template(instrument_json, output_dir):
     #                            generate PHP instrument                           #
     # ============================================================================ #
 
-    with open("templates/LORIS_instrument_builder_php_template.html.jinja2") as filein:
-        loris_template = Template(filein.read(), trim_blocks=True, lstrip_blocks=True)
+    loris_template = get_template(
+        "LORIS_instrument_builder_php_template.html.jinja2", templates_dir
+    )
 
     # ------------------ compile instrument with jinja template ------------------ #
     with open(
@@ -4,25 +4,32 @@ import argparse
 import os
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from validate import (
     valid_readable_file,
     valid_config_parameter,
+    valid_config_section,
     instrument_json,
     directory,
 )
 from generate_instrument import generate_instrument_from_template
-from redcap import all_metadata_to_instrument_jsons
-from qualtrics import get_metadata_from_survey
+from redcap import all_metadata_to_instrument_jsons, data_dictionary_to_instrument_jsons
+from qualtrics import get_metadata_from_survey, QUALTRICS_DEFINITION_CACHE_DIR
 
 
 def main():
     args = parse_args()
     path = args.path
     source = args.source
+    templates_dir = args.templates_dir
 
     # Make output directories
     output_dir = args.output_dir
+    if args.no_cache and args.offline:
+        print("--offline builds from the survey definition cache, and cannot be used with --no_cache")
+        return
+    cachedir = None if args.no_cache else args.cache_dir
     if not os.path.exists(os.path.join(output_dir, "php")):
         os.makedirs(os.path.join(output_dir, "php"))
     if not os.path.exists(os.path.join(output_dir, "sql")):
@@ -35,14 +42,22 @@ def main():
         print(f"Generating instrument from file: {path}")
         with open(path) as json_file:
             instrument_json = json.load(json_file)
-        generate_instrument_from_template(instrument_json, output_dir)
+        generate_instrument_from_template(instrument_json, output_dir, templates_dir)
+    elif args.redcap_dictionary:
+        print(f"Generating instruments from REDCap data dictionary: {args.redcap_dictionary}")
+        instruments = data_dictionary_to_instrument_jsons(args.redcap_dictionary)
+        for instrument in instruments:
+            generate_instrument_from_template(instrument, output_dir, templates_dir)
     elif source:
         print(f"Generating instruments from '{source}'")
         if source == "redcap":
             instruments = all_metadata_to_instrument_jsons()
             for instrument in instruments:
-                generate_instrument_from_template(instrument, output_dir)
+                generate_instrument_from_template(instrument, output_dir, templates_dir)
         if source == "qualtrics":
+            if args.all_surveys and args.project == None:
+                print("--all-surveys requires --project to look up surveys in the config files")
+                return
             if args.project != None:
                 # check they specified project, in which case assume survey information is stored in config files
                 token = valid_config_parameter(
@@ -51,6 +66,26 @@ def main():
                 datacenter = valid_config_parameter(
                     "config/qualtrics_config.ini", args.project, "data-center"
                 )
+                if args.all_surveys:
+                    # build every `id_` survey listed for the project, then stop
+                    surveys = valid_config_section(
+                        "config/qualtrics_survey_import_config.ini",
+                        args.project,
+                        prefix="id_",
+                    )
+                    results = build_all_qualtrics_surveys(
+                        token,
+                        datacenter,
+                        surveys,
+                        output_dir,
+                        workers=args.workers,
+                        templates_dir=templates_dir,
+                        cachedir=cachedir,
+                        offline=args.offline,
+                        stream=args.stream_definition,
+                    )
+                    print_build_summary(results)
+                    return
                 surveylabel = (
                     args.survey
                     if (args.survey != None)
@@ -81,17 +116,108 @@ def main():
                     else input("Enter Qualtrics Survey ID: ")
                 )
 
-            instrument = get_metadata_from_survey(token, datacenter, survey)
+            instrument = get_metadata_from_survey(
+                token,
+                datacenter,
+                survey,
+                cachedir=cachedir,
+                offline=args.offline,
+                stream=args.stream_definition,
+            )
             # print("instrument: ", instrument)
 
             if args.survey != None:
                 # if they specified survey with the config files, replace the instrument name with what's saved in the config file
                 instrument["instrument_name_sql"] = re.sub(r"^id_", "", args.survey)
 
-            generate_instrument_from_template(instrument, output_dir)
+            generate_instrument_from_template(instrument, output_dir, templates_dir)
 
     else:
-        print(f"No inputs defined. Please include --path or --source")
+        print(f"No inputs defined. Please include --path, --redcap-dictionary or --source")
+
+
+def build_qualtrics_survey(
+    token,
+    datacenter,
+    surveylabel,
+    surveyid,
+    output_dir,
+    templates_dir=None,
+    cachedir=None,
+    offline=False,
+    stream=False,
+):
+    """Pull one Qualtrics survey definition and generate its instrument files.
+    The instrument name is taken from the config file label, dropping the `id_` prefix.
+    """
+    instrument = get_metadata_from_survey(
+        token, datacenter, surveyid, cachedir=cachedir, offline=offline, stream=stream
+    )
+    instrument["instrument_name_sql"] = re.sub(r"^id_", "", surveylabel)
+    generate_instrument_from_template(instrument, output_dir, templates_dir)
+    return instrument["instrument_name_sql"]
+
+
+def build_all_qualtrics_surveys(
+    token,
+    datacenter,
+    surveys,
+    output_dir,
+    workers=4,
+    templates_dir=None,
+    cachedir=None,
+    offline=False,
+    stream=False,
+):
+    """Build every survey in `surveys` using a bounded pool of worker threads.
+
+    Args:
+        token (str): Qualtrics API token
+        datacenter (str): Qualtrics Datacenter
+        surveys (dict): survey labels mapped to Qualtrics survey IDs, i.e. {"id_cshq": "SV_..."}
+        output_dir (str): path to the output directory
+        workers (int): maximum number of surveys fetched at the same time
+        templates_dir (str): directory with the jinja2 templates. Defaults to the repository `templates/` directory
+        cachedir (str): directory for cached survey definitions, see qualtrics.get_cached_qualtrics_survey_definition
+        offline (bool): build from cached survey definitions only
+        stream (bool): parse survey definitions incrementally with ijson, see qualtrics.stream_questions_from_survey
+
+    Returns:
+        dict: survey label mapped to (success, message), in the same order as `surveys`
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        future_to_label = {
+            executor.submit(
+                build_qualtrics_survey,
+                token,
+                datacenter,
+                label,
+                surveyid,
+                output_dir,
+                templates_dir,
+                cachedir,
+                offline,
+                stream,
+            ): label
+            for label, surveyid in surveys.items()
+        }
+        for future in as_completed(future_to_label):
+            label = future_to_label[future]
+            try:
+                results[label] = (True, future.result())
+            except Exception as err:
+                # one bad survey should not stop the rest of the batch
+                results[label] = (False, f"{type(err).__name__}: {err}")
+
+    return {label: results[label] for label in surveys}
+
+
+def print_build_summary(results):
+    nsuccess = sum(1 for success, _ in results.values() if success)
+    print(f"\nBuilt {nsuccess} of {len(results)} surveys:")
+    for label, (success, message) in results.items():
+        print(f"\t{'SUCCESS' if success else 'FAILED '}\t{label}\t{message}")
 
 
 def parse_args():
@@ -124,6 +250,23 @@ def parse_args():
             "See EXAMPLE_instrument_details.json"
         ),
     )
+    file_input_output.add_argument(
+        "--redcap-dictionary",
+        dest="redcap_dictionary",
+        type=valid_readable_file,
+        default=None,
+        help=(
+            "Valid path to a REDCap data dictionary export (csv, or json metadata). "
+            "Builds every form without connecting to REDCap."
+        ),
+    )
+    file_input_output.add_argument(
+        "--templates_dir",
+        dest="templates_dir",
+        default=None,
+        type=str,
+        help="Directory with the jinja2 templates. Defaults to the `templates` directory next to instrument_builder.py.",
+    )
     qualtrics_parameters = parser.add_argument_group(
         "file_input_output", "Setting File input/output path"
     )
@@ -146,6 +289,50 @@ def parse_args():
             "If specifying a single survey, this should be the full survey ID."
         ),
     )
+    parser.add_argument(
+        "--all-surveys",
+        dest="all_surveys",
+        action="store_true",
+        help=(
+            "Build every survey labelled `id_*` for --project in the 'config/qualtrics_survey_import_config.ini' configuration file. "
+            "Survey definitions are fetched in parallel."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Maximum number of surveys fetched at the same time with --all-surveys. Defaults to 4.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        dest="cache_dir",
+        type=str,
+        default=QUALTRICS_DEFINITION_CACHE_DIR,
+        help=(
+            f"Directory for cached qualtrics survey definitions. Defaults to '{QUALTRICS_DEFINITION_CACHE_DIR}', so the cache is on unless --no_cache is set. "
+            "A cached definition is reused while the survey's last modified date is unchanged."
+        ),
+    )
+    parser.add_argument(
+        "--no_cache",
+        dest="no_cache",
+        action="store_true",
+        help="Always download qualtrics survey definitions, without reading or writing the --cache_dir cache.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Build qualtrics surveys from cached survey definitions only, without connecting to qualtrics.",
+    )
+    parser.add_argument(
+        "--stream_definition",
+        action="store_true",
+        help=(
+            "Parse qualtrics survey definitions incrementally instead of loading the whole json. "
+            "Lowers memory use for very large surveys. Requires ijson."
+        ),
+    )
     parser.add_argument(
         "--project",
         type=str,
@@ -1,13 +1,74 @@
+import io
+import os
+import time
+import sqlite3
+import configparser
+import numpy as np
 import pandas as pd
 from jinja2 import Template
-# import os
-# import re
+from generate_instrument import convert_instrument_template
 # import json
 # from datetime import datetime
 
-def generate_insert_sql(table_name, data, output_file=None):
+# string values written as NULL, matching templates/mysql_INSERT_VALUES.sql.jinja2
+NULL_STRINGS = ["NA", "<NA>", "nan", "#N/A"]
+
+# MySQL column types whose values are written without a trailing ".0" (pandas stores int columns with NULLs as float)
+INTEGER_SQL_TYPES = ["int", "tinyint", "smallint", "mediumint", "bigint"]
+
+# mysql error numbers that are safe to retry: ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK
+RETRYABLE_ERRNOS = [1205, 1213]
+
+# server defaults for max_allowed_packet, a single statement larger than this is rejected
+# MariaDB 10.2+ defaults to 16MB, MySQL 8.0 to 64MB
+MAX_ALLOWED_PACKET_MARIADB = 16 * 1024 * 1024
+MAX_ALLOWED_PACKET_MYSQL = 64 * 1024 * 1024
+
+
+def generate_insert_sql(
+    table_name,
+    data,
+    output_file=None,
+    stream=False,
+    chunksize=10000,
+    rows_per_statement=None,
+    max_statement_bytes=None,
+    statements_per_transaction=None,
+):
+    """Generate INSERT ... VALUES statement(s) for every row in `data`.
+
+    With `stream=True` the rows are formatted column-wise in chunks of `chunksize` and written
+    straight to `output_file`, instead of rendering the whole statement with the jinja2 template.
+
+    Setting `rows_per_statement` and/or `max_statement_bytes` (i.e. MAX_ALLOWED_PACKET_MARIADB) splits
+    the output into several INSERT statements, and `statements_per_transaction` wraps every N statements
+    in START TRANSACTION/COMMIT. Any of these options implies `stream=True`.
+    """
+    if rows_per_statement or max_statement_bytes or statements_per_transaction:
+        stream = True
+    split_options = {
+        "rows_per_statement": rows_per_statement,
+        "max_statement_bytes": max_statement_bytes,
+        "statements_per_transaction": statements_per_transaction,
+    }
+
+    if stream:
+        if output_file:
+            with open(output_file, 'w') as file:
+                write_insert_sql(
+                    table_name, data, file, chunksize=chunksize, **split_options
+                )
+            print(f"SQL statement has been written to {output_file}")
+            return
+        else:
+            buffer = io.StringIO()
+            write_insert_sql(
+                table_name, data, buffer, chunksize=chunksize, **split_options
+            )
+            return buffer.getvalue()
+
     # Load Jinja2 template
-    with open("templates/mysql_INSERT_VALUES.sql.jinja2", 'r') as filein: 
+    with open("templates/mysql_INSERT_VALUES.sql.jinja2", 'r') as filein:
         insert_template_text = filein.read()
     template = Template(insert_template_text, trim_blocks=True, lstrip_blocks=True)
     # Handle empty values in the DataFrame and convert them to NULL
@@ -25,3 +86,354 @@ def generate_insert_sql(table_name, data, output_file=None):
     else:
         return sql_statement
 
+
+def format_sql_values(data):
+    """Convert every cell in `data` to a SQL literal, one column at a time, returning a 2D numpy array.
+    Missing values and NULL_STRINGS become NULL, everything else is quoted with ' and " doubled.
+    """
+    formatted = []
+    for i in range(data.shape[1]):
+        text, isnull = column_text_and_nulls(data.iloc[:, i])
+        quoted = "'" + text.str.replace("'", "''", regex=False).str.replace('"', '""', regex=False) + "'"
+        formatted.append(np.where(isnull, "NULL", quoted.to_numpy(dtype=object)))
+    return np.column_stack(formatted)
+
+
+def column_text_and_nulls(values):
+    """Return a column as strings, and a boolean numpy array marking the values written as NULL"""
+    text = values.astype(str)
+    isnull = values.isna().to_numpy() | text.isin(NULL_STRINGS).to_numpy()
+    return text, isnull
+
+
+def write_insert_sql(
+    table_name,
+    data,
+    fileout,
+    chunksize=10000,
+    rows_per_statement=None,
+    max_statement_bytes=None,
+    statements_per_transaction=None,
+):
+    """Write INSERT ... VALUES statement(s) for `data` to the open file `fileout`, `chunksize` rows at a time.
+
+    A new statement is started once the current one holds `rows_per_statement` rows, or adding the next
+    row would take it past `max_statement_bytes` (UTF-8 encoded). A single row larger than
+    `max_statement_bytes` is still written, as its own statement.
+    When `statements_per_transaction` is set, every N statements are wrapped in START TRANSACTION/COMMIT.
+    """
+    if data.empty:
+        return
+    columns = data.columns.tolist()
+    header = f"INSERT INTO `{table_name}` ({', '.join(columns)})\nVALUES\n"
+    header_bytes = len(header.encode("utf-8"))
+    separator = ",\n"
+    footer = ";\n"
+
+    in_statement = False
+    statement_rows = 0
+    statement_bytes = 0
+    nstatements = 0
+
+    for start in range(0, len(data), chunksize):
+        rows = format_sql_values(data.iloc[start:start + chunksize])
+        output = []
+        for row in rows:
+            line = "    (" + ", ".join(row) + ")"
+            line_bytes = len(line.encode("utf-8")) if max_statement_bytes else 0
+            # close the current statement if this row would not fit
+            if in_statement and (
+                (rows_per_statement and statement_rows >= rows_per_statement)
+                or (
+                    max_statement_bytes
+                    and statement_bytes + len(separator) + line_bytes + len(footer)
+                    > max_statement_bytes
+                )
+            ):
+                output.append(footer)
+                in_statement = False
+                nstatements += 1
+                if statements_per_transaction and nstatements % statements_per_transaction == 0:
+                    output.append("COMMIT;\n")
+            # start a new statement (and transaction) if needed
+            if not in_statement:
+                if statements_per_transaction and nstatements % statements_per_transaction == 0:
+                    output.append("START TRANSACTION;\n")
+                output.append(header)
+                in_statement = True
+                statement_rows = 0
+                statement_bytes = header_bytes
+            else:
+                output.append(separator)
+                statement_bytes += len(separator)
+            output.append(line)
+            statement_rows += 1
+            statement_bytes += line_bytes
+        fileout.write("".join(output))
+
+    fileout.write(footer)
+    if statements_per_transaction:
+        fileout.write("COMMIT;\n")
+
+
+# ============================================================================ #
+#                        load data directly into database                      #
+# ============================================================================ #
+def get_connection_pool(
+    database="prod", dbconfig=os.path.join("config", "db_config.ini"), pool_size=4
+):
+    """Create a mysql.connector connection pool for a database section in the db_config.ini file
+    (see config/db_config.ini_EXAMPLE). Connections from pool.get_connection() return to the pool on close().
+    """
+    # imported here so writing SQL files does not require mysql.connector
+    from mysql.connector import pooling
+
+    config = configparser.ConfigParser()
+    try:
+        with open(dbconfig) as f:
+            config.read_file(f)
+    except IOError:
+        raise FileNotFoundError(
+            f"database config file ({dbconfig}) not found. Check script directory or path to {dbconfig}"
+        )
+    if not config.has_section(database):
+        raise RuntimeError(
+            f"CONFIG ERROR -- Something went wrong. DB connection {database} not found in {dbconfig} file."
+        )
+    return pooling.MySQLConnectionPool(
+        pool_name=f"loris_{database}",
+        pool_size=pool_size,
+        host=config.get(database, "host"),
+        database=config.get(database, "database"),
+        user=config.get(database, "username"),
+        password=config.get(database, "password"),
+    )
+
+
+def sql_parameter_rows(data):
+    """Convert `data` to a list of row tuples for cursor.executemany.
+    Values are passed as strings, like the quoted values in generate_insert_sql, and NULL values as None.
+    """
+    columns = []
+    for i in range(data.shape[1]):
+        text, isnull = column_text_and_nulls(data.iloc[:, i])
+        columns.append(np.where(isnull, None, text.to_numpy(dtype=object)))
+    return list(zip(*columns))
+
+
+def is_retryable_error(err):
+    """True for lock errors where the batch can be rolled back and run again"""
+    if getattr(err, "errno", None) in RETRYABLE_ERRNOS:
+        return True
+    # sqlite stand-in for local testing
+    return isinstance(err, sqlite3.OperationalError) and "locked" in str(err)
+
+
+def bulk_insert_sql(
+    table_name,
+    data,
+    connection=None,
+    pool=None,
+    batch_size=1000,
+    max_retries=3,
+    retry_wait=1.0,
+):
+    """Insert every row in `data` into `table_name` with cursor.executemany, one transaction per batch.
+
+    Args:
+        table_name (str): table to insert into
+        data (pd.DataFrame): same DataFrame passed to generate_insert_sql, column names must match the table
+        connection: open DB-API connection (mysql.connector or sqlite3). Used if `pool` is not given
+        pool (MySQLConnectionPool): pool to take a connection from, see get_connection_pool()
+        batch_size (int): number of rows per executemany call and transaction
+        max_retries (int): number of times a batch is retried after a deadlock or lock wait timeout
+        retry_wait (float): seconds to wait before the first retry, doubled after each retry
+
+    Returns:
+        int: number of rows inserted
+    """
+    if pool is None and connection is None:
+        raise ValueError("bulk_insert_sql requires a `connection` or a connection `pool`")
+    if data.empty:
+        return 0
+
+    cnx = pool.get_connection() if pool is not None else connection
+    placeholder = "?" if isinstance(cnx, sqlite3.Connection) else "%s"
+    columns = ", ".join(f"`{column}`" for column in data.columns)
+    values = ", ".join([placeholder] * data.shape[1])
+    statement = f"INSERT INTO `{table_name}` ({columns}) VALUES ({values})"
+
+    ninserted = 0
+    try:
+        for start in range(0, len(data), batch_size):
+            rows = sql_parameter_rows(data.iloc[start:start + batch_size])
+            attempt = 0
+            while True:
+                cursor = cnx.cursor()
+                try:
+                    cursor.executemany(statement, rows)
+                    cnx.commit()
+                    break
+                except Exception as err:
+                    cnx.rollback()
+                    if attempt >= max_retries or not is_retryable_error(err):
+                        raise RuntimeError(
+                            f"bulk insert into {table_name} failed on rows {start} to {start + len(rows) - 1} "
+                            f"after {attempt + 1} attempt(s): {err}"
+                        ) from err
+                    time.sleep(retry_wait * 2**attempt)
+                    attempt += 1
+                finally:
+                    cursor.close()
+            ninserted += len(rows)
+    finally:
+        # connections taken from a pool are returned to it on close
+        if pool is not None:
+            cnx.close()
+
+    return ninserted
+
+
+# ============================================================================ #
+#                        LOAD DATA LOCAL INFILE export                         #
+# ============================================================================ #
+# columns every LORIS instrument table starts with, see LORIS_CREATE_instrument_table_template
+LORIS_INSTRUMENT_COLUMNS = {
+    "CommentID": {"type": "varchar", "enum_values": None},
+    "UserID": {"type": "varchar", "enum_values": None},
+    "Examiner": {"type": "varchar", "enum_values": None},
+    "Testdate": {"type": "timestamp", "enum_values": None},
+    "Data_entry_completion_status": {"type": "enum", "enum_values": ["Incomplete", "Complete"]},
+    "Date_taken": {"type": "date", "enum_values": None},
+    "Candidate_Age": {"type": "varchar", "enum_values": None},
+    "Window_Difference": {"type": "int", "enum_values": None},
+}
+
+
+def instrument_table_columns(instrument_json):
+    """Columns of the instrument table, in the order of the CREATE TABLE statement rendered from
+    LORIS_CREATE_instrument_table_template, read from the same fields as the template.
+
+    Returns:
+        dict: column name mapped to {"type": base SQL type, "enum_values": list of enum values or None}
+    """
+    fields = convert_instrument_template(instrument_json)["fields"]
+    columns = {column: dict(info) for column, info in LORIS_INSTRUMENT_COLUMNS.items()}
+    for field in fields.values():
+        if "HEADER:" in field["field_name_sql"]:
+            continue
+        # base type of e.g. varchar(255), int(11) or decimal(5,2)
+        sqltype = str(field["field_type_sql"]).split("(")[0].strip().lower()
+        enum_values = None
+        if sqltype == "enum":
+            enum_values = [str(x) for x in field.get("enum_values_sql", [])]
+            if enum_values and field.get("field_include_not_answered") != False:
+                enum_values.append("not_answered")
+        columns[field["field_name_sql"]] = {"type": sqltype, "enum_values": enum_values}
+        if field.get("associated_status_field"):
+            columns[field["field_name_sql"] + "_status"] = {"type": "enum", "enum_values": ["not_answered"]}
+    return columns
+
+
+def coerce_column(values, column_info):
+    """Coerce a column to the format expected by its SQL type. Returns strings and a NULL mask like column_text_and_nulls.
+    enum: values not in the enum become NULL. date: values are parsed and written as YYYY-MM-DD, unparseable dates become NULL.
+    int: float values like "3.0" are written as "3".
+    """
+    sqltype = column_info["type"]
+    if sqltype == "date":
+        # parse every value on its own, so one format in the first row does not NULL dates written another way
+        dates = pd.to_datetime(values, errors="coerce", format="mixed")
+        text, isnull = column_text_and_nulls(values)
+        invalid = dates.isna().to_numpy() & ~isnull
+        if invalid.any():
+            print(
+                f"WARNING: {invalid.sum()} value(s) in column {values.name} are not dates and were written as NULL: {sorted(set(text[invalid]))[:10]}"
+            )
+        return dates.dt.strftime("%Y-%m-%d").astype(str), isnull | invalid
+
+    text, isnull = column_text_and_nulls(values)
+    if sqltype == "enum" or sqltype in INTEGER_SQL_TYPES:
+        text = text.str.replace(r"^(-?\d+)\.0+$", r"\1", regex=True)
+    if sqltype == "enum":
+        invalid = ~text.isin(column_info["enum_values"]).to_numpy() & ~isnull
+        if invalid.any():
+            print(
+                f"WARNING: {invalid.sum()} value(s) in column {values.name} are not in the enum and were written as NULL: {sorted(set(text[invalid]))[:10]}"
+            )
+        isnull = isnull | invalid
+    return text, isnull
+
+
+def format_tsv_values(data, columns=None):
+    """Convert every cell in `data` to an escaped LOAD DATA value, returning a 2D numpy array.
+    Backslash, tab, newline, carriage return and NUL are escaped, and NULL values are written as \\N.
+    `columns` (see instrument_table_columns) enables enum/date coercion for the listed columns.
+    """
+    formatted = []
+    for i in range(data.shape[1]):
+        values = data.iloc[:, i]
+        if columns is not None and values.name in columns:
+            text, isnull = coerce_column(values, columns[values.name])
+        else:
+            text, isnull = column_text_and_nulls(values)
+        escaped = (
+            text.str.replace("\\", "\\\\", regex=False)
+            .str.replace("\t", "\\t", regex=False)
+            .str.replace("\n", "\\n", regex=False)
+            .str.replace("\r", "\\r", regex=False)
+            .str.replace("\0", "\\0", regex=False)
+        )
+        formatted.append(np.where(isnull, "\\N", escaped.to_numpy(dtype=object)))
+    return np.column_stack(formatted)
+
+
+def generate_load_data_sql(
+    table_name,
+    data,
+    output_file,
+    tsv_file=None,
+    instrument_json=None,
+    chunksize=10000,
+):
+    """Write `data` to a TSV file plus a LOAD DATA LOCAL INFILE statement that loads it into `table_name`.
+
+    Args:
+        table_name (str): table to load into
+        data (pd.DataFrame): same DataFrame passed to generate_insert_sql
+        output_file (str): path of the .sql file with the LOAD DATA statement
+        tsv_file (str): path of the data file. Defaults to `output_file` with a .tsv extension
+        instrument_json (dict): instrument template used to create the table. When given, the column list
+            follows the CREATE TABLE order, columns not in the table are skipped, and enum/date values are coerced
+        chunksize (int): number of rows formatted and written at a time
+    """
+    if tsv_file is None:
+        tsv_file = os.path.splitext(output_file)[0] + ".tsv"
+
+    columns = None
+    if instrument_json is not None:
+        columns = instrument_table_columns(instrument_json)
+        skipped = [column for column in data.columns if column not in columns]
+        if skipped:
+            print(f"WARNING: columns not in the {table_name} table are not loaded: {skipped}")
+        data = data[[column for column in columns if column in data.columns]]
+
+    with open(tsv_file, "w", encoding="utf-8", newline="") as file:
+        file.write("\t".join(data.columns) + "\n")
+        for start in range(0, len(data), chunksize):
+            rows = format_tsv_values(data.iloc[start:start + chunksize], columns)
+            file.write("".join("\t".join(row) + "\n" for row in rows))
+
+    column_list = ", ".join(f"`{column}`" for column in data.columns)
+    tsv_path = tsv_file.replace("\\", "/").replace("'", "\\'")
+    with open(output_file, "w") as file:
+        file.write(
+            f"LOAD DATA LOCAL INFILE '{tsv_path}'\n"
+            f"INTO TABLE `{table_name}`\n"
+            "CHARACTER SET utf8\n"
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'\n"
+            "LINES TERMINATED BY '\\n'\n"
+            "IGNORE 1 LINES\n"
+            f"({column_list});\n"
+        )
+    print(f"LOAD DATA statement has been written to {output_file} with data in {tsv_file}")
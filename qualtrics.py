@@ -1,13 +1,28 @@
 import io, os
+import functools
+import html
 import sys
 import re
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
 import configparser
 import json
 import zipfile
+import shutil
+import tempfile
 import time
 import pandas as pd
+from generate_instrument import sql_to_php_field_type
+
+try:
+    # optional, only needed to stream survey definitions (--stream_definition)
+    import ijson
+except ImportError:
+    ijson = None
 
 # from redcap_config import token, api_route
 # import pandas as pd
@@ -41,7 +56,29 @@ def get_question_tags(surveydata):
 # ============================================================================ #
 #                              parse question data                             #
 # ============================================================================ #
-htmlcleaner = re.compile("<.*?>|&([a-z0-9]+|#[0-9]{1,6}|#x[0-9a-f]{1,6});")
+htmlcleaner = re.compile("<.*?>|&([a-zA-Z0-9]+|#[0-9]{1,6}|#x[0-9a-fA-F]{1,6});")
+# number of distinct strings kept by clean_html, answer scales are repeated across most questions
+QUALTRICS_HTML_CACHE_SIZE = 4096
+
+
+def unescape_html_match(match):
+    # html tags are removed, entities are converted to the character they represent
+    if match.group(1) is None:
+        return ""
+    return html.unescape(match.group(0)).replace("\xa0", " ")
+
+
+@functools.lru_cache(maxsize=QUALTRICS_HTML_CACHE_SIZE)
+def clean_html(text):
+    """Remove html tags and unescape html entities in qualtrics question and choice text
+
+    Args:
+        text (str): question or choice text from the survey definition
+
+    Returns:
+        str: the cleaned text. Results are cached, since the same choice text is used by many questions
+    """
+    return htmlcleaner.sub(unescape_html_match, text).strip()
 
 
 def get_TE_question_data(questiondata):
@@ -54,11 +91,11 @@ def get_TE_question_data(questiondata):
     )
     if "Choices" in questiondata:
         subquestions = {
-            x: re.sub(htmlcleaner, "", questiondata["Choices"][x]["Display"])
+            x: clean_html(questiondata["Choices"][x]["Display"])
             for x in questiondata["Choices"].keys()
         }
 
-    questiontext = re.sub(htmlcleaner, "", questiondata["QuestionText"])
+    questiontext = clean_html(questiondata["QuestionText"])
     questiontype = questiondata["QuestionType"]
     questionselector = questiondata["Selector"]
     questioninfo = {}
@@ -94,7 +131,7 @@ def get_MC_question_data(questiondata):
         else questiondata["DataExportTag"]
     )
     questiontype = questiondata["QuestionType"]
-    questiontext = re.sub(htmlcleaner, "", questiondata["QuestionText"])
+    questiontext = clean_html(questiondata["QuestionText"])
     if "SubSelector" in questiondata.keys():
         questionselector = f'{questiondata["Selector"]}_{questiondata["SubSelector"]}'
     else:
@@ -107,7 +144,7 @@ def get_MC_question_data(questiondata):
         and questiondata["SubSelector"] == "TX"
     ):
         answers = {
-            x: re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])
+            x: clean_html(questiondata["Choices"][str(x)]["Display"])
             for x in questiondata["ChoiceOrder"]
         }
         # print(f"processing question data for {questionid} with tag {questiontype}")
@@ -127,13 +164,13 @@ def get_MC_question_data(questiondata):
                     "Tag": f"{questiontag}_{x}_TEXT",
                     "ParentID": questionid,
                     "QuestionType": "TE",
-                    "QuestionText": f'{questiontext} - {re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])} - Text',
+                    "QuestionText": f'{questiontext} - {clean_html(questiondata["Choices"][str(x)]["Display"])} - Text',
                     "Selector": "SL",
                     "Answers": None,
                 }
     if questiondata["Selector"] in ["DL"]:
         answers = {
-            x: re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])
+            x: clean_html(questiondata["Choices"][str(x)]["Display"])
             for x in questiondata["ChoiceOrder"]
         }
         questioninfo[questionid] = {
@@ -152,7 +189,7 @@ def get_MC_question_data(questiondata):
         #             "Tag": f"{questiontag}_{x}_TEXT",
         #             "ParentID": questionid,
         #             "QuestionType": "TE",
-        #             "QuestionText": f'{questiontext} - {re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])} - Text',
+        #             "QuestionText": f'{questiontext} - {clean_html(questiondata["Choices"][str(x)]["Display"])} - Text',
         #             "Selector": "SL",
         #             "Answers": None,
         #         }
@@ -162,7 +199,7 @@ def get_MC_question_data(questiondata):
         and questiondata["SubSelector"] == "TX"
     ):
         answers = {
-            x: re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])
+            x: clean_html(questiondata["Choices"][str(x)]["Display"])
             for x in questiondata["ChoiceOrder"]
         }
         for x in answers.keys():
@@ -173,7 +210,7 @@ def get_MC_question_data(questiondata):
                 "ParentText": questiontext,
                 "ParentSelector": questionselector,
                 "QuestionType": questiontype,
-                "QuestionText": f"{questiontext} - {re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])}",
+                "QuestionText": f"{questiontext} - {clean_html(questiondata["Choices"][str(x)]["Display"])}",
                 "Answers": {"1": "yes"},
             }
             # for answers that might have text entry included, as in selecting "Other: "
@@ -184,7 +221,7 @@ def get_MC_question_data(questiondata):
                         "Tag": f"{questiontag}_{x}_TEXT",
                         "ParentID": questionid,
                         "QuestionType": "TE",
-                        "QuestionText": f'{questiontext} - {re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])} - Text',
+                        "QuestionText": f'{questiontext} - {clean_html(questiondata["Choices"][str(x)]["Display"])} - Text',
                         "Selector": "SL",
                         "Answers": None,
                     }
@@ -214,14 +251,14 @@ def get_Matrix_question_data(questiondata):
         else questiondata["DataExportTag"]
     )
     questiontype = questiondata["QuestionType"]
-    questiontext = re.sub(htmlcleaner, "", questiondata["QuestionText"])
+    questiontext = clean_html(questiondata["QuestionText"])
     questionselector = f'{questiondata["Selector"]}_{questiondata["SubSelector"]}'
     questioninfo = {}
     if questiondata["Selector"] == "Likert":
         if questiondata["SubSelector"] == "SingleAnswer":
             # subquestionorder = questiondata["ChoiceOrder"]
             subquestions = {
-                x: re.sub(htmlcleaner, "", questiondata["Choices"][x]["Display"])
+                x: clean_html(questiondata["Choices"][x]["Display"])
                 for x in questiondata["Choices"].keys()
             }
             # subquestions = {x:questiondata["Choices"][str(x)]["Display"] for x in questiondata["ChoiceOrder"]}
@@ -251,7 +288,7 @@ def get_Matrix_question_data(questiondata):
                         "ParentText": questiontext,
                         "ParentSelector": questionselector,
                         "QuestionType": "TE",
-                        "QuestionText": f'{re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])} - Text',
+                        "QuestionText": f'{clean_html(questiondata["Choices"][str(x)]["Display"])} - Text',
                         "Selector": "SL",
                         "Answers": None,
                     }
@@ -260,7 +297,7 @@ def get_Matrix_question_data(questiondata):
             # TODO: implement this routine!
             # subquestionorder = questiondata["ChoiceOrder"]
             subquestions = {
-                x: re.sub(htmlcleaner, "", questiondata["Choices"][x]["Display"])
+                x: clean_html(questiondata["Choices"][x]["Display"])
                 for x in questiondata["Choices"].keys()
             }
             # subquestions = {x:questiondata["Choices"][str(x)]["Display"] for x in questiondata["ChoiceOrder"]}
@@ -293,7 +330,7 @@ def get_Matrix_question_data(questiondata):
                             "ParentText": questiontext,
                             "ParentSelector": questionselector,
                             "QuestionType": "TE",
-                            "QuestionText": f'{re.sub(htmlcleaner, "", questiondata["Choices"][str(x)]["Display"])} - Text',
+                            "QuestionText": f'{clean_html(questiondata["Choices"][str(x)]["Display"])} - Text',
                             "Selector": "SL",
                             "Answers": None,
                         }
@@ -310,7 +347,7 @@ def get_Matrix_question_data(questiondata):
             # If "Choices" is a key in the dict, load the choices
             if "Choices" in questiondata.keys():
                 subquestions = {
-                    x: re.sub(htmlcleaner, "", questiondata["Choices"][x]["Display"])
+                    x: clean_html(questiondata["Choices"][x]["Display"])
                     for x in questiondata["Choices"].keys()
                 }
 
@@ -344,7 +381,7 @@ def get_Matrix_question_data(questiondata):
                 }
     elif questiondata["Selector"] == "TE":
         subquestions = {
-            x: re.sub(htmlcleaner, "", questiondata["Choices"][x]["Display"])
+            x: clean_html(questiondata["Choices"][x]["Display"])
             for x in questiondata["Choices"].keys()
         }
 
@@ -369,7 +406,7 @@ def get_Matrix_question_data(questiondata):
 
     elif questiondata["Selector"] == "Profile":
         subquestions = {
-            x: re.sub(htmlcleaner, "", questiondata["Choices"][x]["Display"])
+            x: clean_html(questiondata["Choices"][x]["Display"])
             for x in questiondata["Choices"].keys()
         }
 
@@ -403,7 +440,7 @@ def get_SBS_question_data(questiondata):
         else questiondata["DataExportTag"]
     )
     questiontype = questiondata["QuestionType"]
-    questiontext = re.sub(htmlcleaner, "", questiondata["QuestionText"])
+    questiontext = clean_html(questiondata["QuestionText"])
     questionselector = questiondata["Selector"]
     questioninfo = {}
     # loop through each additional question/column to get the subquestions and answer choices
@@ -418,7 +455,7 @@ def get_SBS_question_data(questiondata):
                 "SuperParentID": questionid,
                 "SuperParentTag": questiontag,
                 "SuperParentType": questiontype,
-                "SuperParentText": re.sub(htmlcleaner, "", questiontext),
+                "SuperParentText": questiontext,
                 "SuperParentSelector": questionselector,
             }
         )
@@ -479,6 +516,32 @@ def pull_question_ids_from_dictionary(surveyDict: dict):
     return questionids
 
 
+def index_survey_blocks(blockdata):
+    """Index every question in the survey blocks in a single pass
+
+    Args:
+        blockdata (dict): The "result" "Blocks" response type from the qualtrics survey
+
+    Returns:
+        dict: {QuestionID: {"BlockID", "BlockType", "Position"}} in block order. Position is the question's order within the blocks. A question that appears in any "Trash" block is marked with BlockType "Trash".
+    """
+    index = {}
+    for blockid, block in blockdata.items():
+        for element in block.get("BlockElements", []):
+            questionid = element.get("QuestionID")
+            if questionid is None:
+                continue
+            if questionid not in index:
+                index[questionid] = {
+                    "BlockID": blockid,
+                    "BlockType": block.get("Type"),
+                    "Position": len(index),
+                }
+            elif block.get("Type") == "Trash":
+                index[questionid]["BlockType"] = "Trash"
+    return index
+
+
 def parse_questions_from_survey(surveydata, sorted=True):
     """get standardized question data from qualtrics survey response
 
@@ -523,7 +586,7 @@ def parse_questions_from_survey(surveydata, sorted=True):
             )"""
 
         # Go through all the question blocks, and get every question ID within them
-        tmpquestions = pull_question_ids_from_dictionary(surveydata["result"]["Blocks"])
+        tmpquestions = index_survey_blocks(surveydata["result"]["Blocks"])
         for x in tmpquestions:
             # loop through each question and parse the question data
             all_survey_questions.update(
@@ -554,18 +617,11 @@ def remove_trash_questions(blockdata, questiondata):
         dict: Essentially just questiondata with the trash questions removed
     """
     outdata = {}
-    # trashdata = [
-    #     y["QuestionID"]
-    #     for x in blockdata.keys()
-    #     if blockdata[str(x)]["Type"] == "Trash" if "BlockElements" not in blockdata[str(x)].keys() else  for y in blockdata[str(x)]["BlockElements"] if blockdata[str(x)]["Type"] == "Trash"
-    # ]
-    trashdata = []
-    for x in blockdata.keys():
-        if "BlockElements" not in blockdata[x].keys():
-            continue
-        for y in blockdata[str(x)]["BlockElements"]:
-            if blockdata[str(x)]["Type"] == "Trash":
-                trashdata.append(y["QuestionID"])
+    trashdata = {
+        x
+        for x, y in index_survey_blocks(blockdata).items()
+        if y["BlockType"] == "Trash"
+    }
 
     for x in questiondata.keys():
         # since some questions have multiple questions, we need to filter by parentID or questionID
@@ -574,7 +630,8 @@ def remove_trash_questions(blockdata, questiondata):
             if "ParentID" in questiondata[x].keys()
             else questiondata[x]["ID"]
         )
-        if compareid not in trashdata:
+        # side by side sub-questions have ParentIDs like QID52#1, so compare the block QuestionID
+        if compareid.split("#")[0] not in trashdata:
             outdata[x] = questiondata[x]
 
     return outdata
@@ -589,35 +646,128 @@ def get_questions_from_survey(surveydata):
     Returns:
         dict : questiondata in standardized format with "trash" questions removed
     """
-    qdata = parse_questions_from_survey(surveydata)
-    questiondata = remove_trash_questions(surveydata["result"]["Blocks"], qdata)
+    questiondata = {}
+    # index the blocks once, and skip trash questions before they are parsed
+    blockindex = index_survey_blocks(surveydata["result"]["Blocks"])
+    for x, block in blockindex.items():
+        if block["BlockType"] == "Trash":
+            continue
+        questiondata.update(parse_question_data(surveydata["result"]["Questions"][x]))
     return questiondata
 
 
+def stream_questions_from_survey(f, prefix=""):
+    """Get parsed question data from a survey definition json file without loading the whole definition
+
+    The file is read twice with ijson: first for the survey name, status and block index, then one question at a time.
+    Trash questions are skipped before parsing, and only the parsed question data is kept.
+
+    Args:
+        f (file): binary, seekable file with the survey definition json (api response or cache file)
+        prefix (str): ijson prefix of the api response within the file, "definition" for cache files
+
+    Returns:
+        tuple: (survey name, questiondata in the same format as get_questions_from_survey)
+    """
+    if ijson is None:
+        raise RuntimeError(
+            "Streaming survey definitions requires ijson. Install it with: pip install ijson"
+        )
+    prefix = f"{prefix}." if prefix else ""
+
+    # first pass: only the small values, and which block each question is in
+    f.seek(0)
+    surveyname, httpstatus, errormessage = None, None, None
+    blockdata = {}
+    blockprefix = f"{prefix}result.Blocks."
+    for event_prefix, event, value in ijson.parse(f, use_float=True):
+        if event_prefix.startswith(blockprefix):
+            blockid, _, path = event_prefix[len(blockprefix) :].partition(".")
+            block = blockdata.setdefault(blockid, {"BlockElements": []})
+            if path == "Type":
+                block["Type"] = value
+            elif path == "BlockElements.item.QuestionID":
+                block["BlockElements"].append({"QuestionID": value})
+        elif event_prefix == f"{prefix}result.SurveyName":
+            surveyname = value
+        elif event_prefix == f"{prefix}meta.httpStatus":
+            httpstatus = value
+        elif event_prefix == f"{prefix}meta.error.errorMessage":
+            errormessage = value
+
+    if httpstatus is not None and re.search(pattern=r"^200\s", string=httpstatus) is None:
+        raise RuntimeError(f"API request failed: {httpstatus}, {errormessage}")
+
+    # second pass: parse questions as they are decoded, in block order
+    blockindex = index_survey_blocks(blockdata)
+    parsed = {}
+    f.seek(0)
+    for questionid, question in ijson.kvitems(f, f"{prefix}result.Questions", use_float=True):
+        if questionid in blockindex and blockindex[questionid]["BlockType"] != "Trash":
+            parsed[questionid] = parse_question_data(question)
+
+    questiondata = {}
+    for x in blockindex:
+        questiondata.update(parsed.get(x, {}))
+    return surveyname, questiondata
+
+
 # def convert_name_for_sql(name):
 
 
-def get_metadata_from_survey(token, datacenter, surveyid):
+def get_metadata_from_survey(
+    token, datacenter, surveyid, cachedir=None, offline=False, stream=False
+):
     """Generates the metadata information from the Qualtrics survey to create the LORIS instrument
 
     Args:
         token (str): Qualtrics API token
         datacenter (str): Qualtrics Datacenter
         surveyid (str): Qualtrics survey ID
+        cachedir (str): directory for cached survey definitions. If None, the definition is always downloaded
+        offline (bool): build from the cached definition only, without any API request
+        stream (bool): parse the definition incrementally with ijson, instead of loading the whole json
 
     Returns:
         json: json string of the instrument_data
     """
-    # pull survey question data from API
-    surveydata = get_qualtrics_survey_definition(token, datacenter, surveyid)
-    # process data into question format that mirrors data output
-    parseddata = get_questions_from_survey(surveydata)
+    # pull survey question data from API, or the local cache
+    if stream and (cachedir is not None or offline):
+        cachefile = get_cached_qualtrics_survey_definition(
+            token,
+            datacenter,
+            surveyid,
+            cachedir=cachedir or QUALTRICS_DEFINITION_CACHE_DIR,
+            offline=offline,
+            stream=True,
+        )
+        with open(cachefile, "rb") as f:
+            surveyname, parseddata = stream_questions_from_survey(f, prefix="definition")
+    elif stream:
+        with get_qualtrics_survey_definition(
+            token, datacenter, surveyid, stream=True
+        ) as f:
+            surveyname, parseddata = stream_questions_from_survey(f)
+    else:
+        if cachedir is not None or offline:
+            surveydata = get_cached_qualtrics_survey_definition(
+                token,
+                datacenter,
+                surveyid,
+                cachedir=cachedir or QUALTRICS_DEFINITION_CACHE_DIR,
+                offline=offline,
+            )
+        else:
+            surveydata = get_qualtrics_survey_definition(token, datacenter, surveyid)
+        surveyname = surveydata["result"]["SurveyName"]
+        # process data into question format that mirrors data output
+        parseddata = get_questions_from_survey(surveydata)
     # get question groups
 
     # convert parsed data into the LORIS_instrument_builder instrument template format
     instrument_data = {
-        "instrument_name": surveydata["result"]["SurveyName"],
-        "instrument_name_sql": surveydata["result"]["SurveyName"]
+        "instrument_name": surveyname,
+        "instrument_name_sql": surveyname
         .lower()
         .replace(" ", "_"),
         "pages": {},
@@ -697,7 +847,64 @@ def get_metadata_from_survey(token, datacenter, surveyid):
 # ============================================================================ #
 #                           API Get Survey Definition                          #
 # ============================================================================ #
-def qualtrics_api_request(method, baseUrl, headers):
+# (connect, read) timeouts in seconds for every Qualtrics API request
+QUALTRICS_TIMEOUT = (10, 120)
+# retry rate limits (429) and server errors with exponential backoff, waiting for Retry-After when it is sent
+QUALTRICS_RETRY = Retry(
+    total=6,
+    backoff_factor=1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "POST", "DELETE"],
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+_qualtrics_session = None
+_qualtrics_session_lock = threading.Lock()
+
+# shared limit on requests per second across threads, None is unlimited. See set_qualtrics_rate_limit
+_qualtrics_rate_limit = None
+_qualtrics_next_request = 0.0
+_qualtrics_rate_lock = threading.Lock()
+
+
+def set_qualtrics_rate_limit(requests_per_second=None):
+    """Limit how many Qualtrics API requests are sent per second by all threads together. None removes the limit."""
+    global _qualtrics_rate_limit
+    _qualtrics_rate_limit = requests_per_second
+
+
+def wait_for_qualtrics_rate_limit():
+    """Block until the next request is allowed under the shared rate limit"""
+    global _qualtrics_next_request
+    if not _qualtrics_rate_limit:
+        return
+    with _qualtrics_rate_lock:
+        now = time.monotonic()
+        wait = _qualtrics_next_request - now
+        _qualtrics_next_request = max(now, _qualtrics_next_request) + 1.0 / _qualtrics_rate_limit
+    if wait > 0:
+        time.sleep(wait)
+
+
+def get_qualtrics_session():
+    """Return the requests.Session shared by all Qualtrics API calls.
+    Connections are kept alive between requests, so pulling many surveys does not repeat the TLS handshake.
+    """
+    global _qualtrics_session
+    with _qualtrics_session_lock:
+        if _qualtrics_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                max_retries=QUALTRICS_RETRY, pool_connections=4, pool_maxsize=16
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _qualtrics_session = session
+        return _qualtrics_session
+
+
+def qualtrics_api_request(method, baseUrl, headers, data=None, stream=False):
     response = None
 
     apimethod = str(method).upper().strip()
@@ -708,12 +915,24 @@ def qualtrics_api_request(method, baseUrl, headers):
         )
 
     try:
-        response = requests.request(apimethod, baseUrl, headers=headers)
+        wait_for_qualtrics_rate_limit()
+        response = get_qualtrics_session().request(
+            apimethod,
+            baseUrl,
+            headers=headers,
+            data=data,
+            stream=stream,
+            timeout=QUALTRICS_TIMEOUT,
+        )
         response.raise_for_status()  # to catch HTTPError
     except requests.exceptions.Timeout:
         raise TimeoutError(
             f"qualtrics api request failed due to timeout \n\tRequest: {baseUrl}"
         )  # \n\tHeaders: {headers}")
+    except requests.exceptions.ConnectionError as err:
+        raise RuntimeError(
+            f"qualtrics api request failed to connect after retries \n\tRequest: {baseUrl} \n\t{err}"
+        )
     except requests.exceptions.TooManyRedirects:
         raise RuntimeError(
             f"URL request was bad. Try updating request. \n\tRequest: {baseUrl}"
@@ -728,12 +947,20 @@ def qualtrics_api_request(method, baseUrl, headers):
     return response
 
 
-def get_qualtrics_survey_definition(token, datacenter, surveyid):
+def get_qualtrics_survey_definition(token, datacenter, surveyid, stream=False):
+    """Get the survey definition from the Qualtrics API.
+    With `stream=True` the response is not decoded, and a spooled temporary file with the json is returned for stream_questions_from_survey
+    """
     baseUrl = "https://{0}.qualtrics.com/API/v3/survey-definitions/{1}".format(
         datacenter, surveyid
     )
     headers = {"x-api-token": token}
 
+    if stream:
+        return download_to_spooled_file(
+            qualtrics_api_request("GET", baseUrl, headers, stream=True)
+        )
+
     response = qualtrics_api_request("GET", baseUrl, headers).json()
 
     # we check if the response is okay, and if it is not, we raise the RuntimeError
@@ -745,6 +972,136 @@ def get_qualtrics_survey_definition(token, datacenter, surveyid):
     return response
 
 
+# ============================================================================ #
+#                         survey definition local cache                        #
+# ============================================================================ #
+QUALTRICS_DEFINITION_CACHE_DIR = ".qualtrics_cache"
+
+
+def get_qualtrics_survey_last_modified(token, datacenter, surveyid):
+    """Get the survey's last modified timestamp from the (small) survey metadata endpoint"""
+    baseUrl = "https://{0}.qualtrics.com/API/v3/surveys/{1}".format(
+        datacenter, surveyid
+    )
+    headers = {"x-api-token": token}
+    response = qualtrics_api_request("GET", baseUrl, headers).json()
+    return response["result"]["lastModifiedDate"]
+
+
+def get_cached_qualtrics_survey_definition(
+    token,
+    datacenter,
+    surveyid,
+    cachedir=QUALTRICS_DEFINITION_CACHE_DIR,
+    offline=False,
+    stream=False,
+):
+    """Return the survey definition from `cachedir`, downloading it only if the survey changed since it was cached.
+
+    The cache file `{cachedir}/{surveyid}.json` stores the definition with the survey's LastModified timestamp,
+    which is compared to the current one from get_qualtrics_survey_last_modified before the cached copy is used.
+    With `offline=True` the cached copy is used without checking, and a missing cache file raises FileNotFoundError.
+    With `stream=True` the definition is never decoded: the path of the up to date cache file is returned instead.
+    """
+    cachefile = os.path.join(cachedir, f"{surveyid}.json")
+    cached, cachedmodified = None, None
+    if os.path.exists(cachefile):
+        if stream:
+            if ijson is None:
+                raise RuntimeError(
+                    "Streaming survey definitions requires ijson. Install it with: pip install ijson"
+                )
+            with open(cachefile, "rb") as f:
+                cachedmodified = next(ijson.items(f, "LastModified"), None)
+        else:
+            with open(cachefile) as f:
+                cached = json.load(f)
+            cachedmodified = cached["LastModified"]
+
+    if offline:
+        if cachedmodified is None:
+            raise FileNotFoundError(
+                f"No cached survey definition for {surveyid} in {cachedir}. Run once without --offline to cache it."
+            )
+        print(f"Using cached definition of {surveyid} (last modified {cachedmodified})")
+        return cachefile if stream else cached["definition"]
+
+    lastmodified = get_qualtrics_survey_last_modified(token, datacenter, surveyid)
+    if cachedmodified is not None and cachedmodified == lastmodified:
+        print(f"Using cached definition of {surveyid} (last modified {lastmodified})")
+        return cachefile if stream else cached["definition"]
+
+    # exist_ok: --all-surveys workers can create the directory at the same time
+    os.makedirs(cachedir, exist_ok=True)
+    # write to a temporary file first, so an interrupted run cannot leave a partial cache file
+    tmpfile = cachefile + ".tmp"
+    if stream:
+        # copy the response bytes into the cache file as they are downloaded, without decoding them
+        with get_qualtrics_survey_definition(
+            token, datacenter, surveyid, stream=True
+        ) as definition, open(tmpfile, "wb") as f:
+            f.write(f'{{"LastModified": {json.dumps(lastmodified)}, "definition": '.encode())
+            shutil.copyfileobj(definition, f)
+            f.write(b"}")
+        os.replace(tmpfile, cachefile)
+        return cachefile
+
+    definition = get_qualtrics_survey_definition(token, datacenter, surveyid)
+    with open(tmpfile, "w") as f:
+        json.dump({"LastModified": lastmodified, "definition": definition}, f)
+    os.replace(tmpfile, cachefile)
+    return definition
+
+
+# timezone used for exported dates, and for startDate watermarks
+QUALTRICS_TIMEZONE = "America/Chicago"
+
+# encoding used to read response exports of every format. Pass `encoding` (i.e. "utf-8-sig") for exports written differently
+QUALTRICS_EXPORT_ENCODING = "UTF-16"
+
+# export progress polling: first wait, longest wait between checks, and overall limit (seconds)
+QUALTRICS_POLL_INTERVAL = 0.5
+QUALTRICS_MAX_POLL_INTERVAL = 10.0
+QUALTRICS_EXPORT_TIMEOUT = 1800
+
+
+def wait_for_qualtrics_export(
+    requestCheckUrl,
+    headers,
+    poll_interval=QUALTRICS_POLL_INTERVAL,
+    max_poll_interval=QUALTRICS_MAX_POLL_INTERVAL,
+    timeout=QUALTRICS_EXPORT_TIMEOUT,
+    showprogress=True,
+):
+    """Poll the export-progress endpoint until the export is complete or failed.
+    Checks start `poll_interval` seconds apart and the wait doubles after every check, up to `max_poll_interval`.
+
+    Returns:
+        dict: decoded json of the last progress response
+
+    Raises:
+        TimeoutError: the export did not finish within `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    wait = poll_interval
+    while True:
+        requestCheck = qualtrics_api_request("GET", requestCheckUrl, headers).json()
+        if showprogress:
+            progress(
+                float(requestCheck["result"]["percentComplete"]),
+                100.0,
+                prefix="Progress\t\t",
+            )
+        if requestCheck["result"]["status"] in ["complete", "failed"]:
+            return requestCheck
+        if time.monotonic() + wait > deadline:
+            raise TimeoutError(
+                f"qualtrics export did not finish within {timeout} seconds \n\tRequest: {requestCheckUrl}"
+            )
+        time.sleep(wait)
+        wait = min(wait * 2, max_poll_interval)
+
+
 def get_qualtrics_survey_responses(
     token,
     datacenter,
@@ -754,7 +1111,22 @@ def get_qualtrics_survey_responses(
     fileprefix=None,
     saveoutput=False,
     outputdirectory="MyQualtricsDownloads",
+    poll_interval=QUALTRICS_POLL_INTERVAL,
+    max_poll_interval=QUALTRICS_MAX_POLL_INTERVAL,
+    export_timeout=QUALTRICS_EXPORT_TIMEOUT,
+    chunksize=None,
+    startdate=None,
+    showprogress=True,
+    encoding=QUALTRICS_EXPORT_ENCODING,
 ):
+    """Export survey responses from Qualtrics and read them into pandas.
+    The download is read in memory and only written to `outputdirectory` if `saveoutput` is True.
+    `lastpulldate` (YYYY-MM-DD) exports responses from midnight of that day, `startdate` (ISO 8601) from an exact time.
+    `encoding` is used to read the export, every format is read as UTF-16 by default.
+
+    Returns:
+        pd.DataFrame: survey responses, or an iterator of DataFrames of `chunksize` rows if `chunksize` is set
+    """
     # baseUrl = "https://{0}.qualtrics.com/API/v3/surveys/{1}/export-responses/".format(datacenter, surveyid)
     # headers = {"content-type": "application/json", "x-api-token": token}
 
@@ -781,8 +1153,6 @@ def get_qualtrics_survey_responses(
     # lastpulldate = lastpulldate
 
     # Setting static parameters
-    requestCheckProgress = 0.0
-    progressStatus = "inProgress"
     baseUrl = "https://{0}.qualtrics.com/API/v3/surveys/{1}/export-responses/".format(
         datacenter, surveyid
     )
@@ -793,7 +1163,12 @@ def get_qualtrics_survey_responses(
 
     # Step 1: Creating Data Export
     downloadRequestUrl = baseUrl
-    if lastpulldate == None:
+    if startdate != None:
+        # full ISO 8601 timestamp, i.e. from sync_qualtrics_survey_responses
+        downloadRequestPayload = json.dumps(
+            {"format": fileformat, "startDate": startdate, "timeZone": QUALTRICS_TIMEZONE}
+        )
+    elif lastpulldate == None:
         downloadRequestPayload = (
             '{"format":"' + fileformat + '", "timeZone":"America/Chicago"}'
         )
@@ -805,96 +1180,330 @@ def get_qualtrics_survey_responses(
             + lastpulldate
             + 'T00:00:00-06:00", "timeZone":"America/Chicago"}'
         )
-    downloadRequestResponse = requests.request(
-        "POST", downloadRequestUrl, data=downloadRequestPayload, headers=headers
+    downloadRequestResponse = qualtrics_api_request(
+        "POST", downloadRequestUrl, headers, data=downloadRequestPayload
     )
     progressId = downloadRequestResponse.json()["result"]["progressId"]
     # print(downloadRequestResponse.text)
 
     # Step 2: Checking on Data Export Progress and waiting until export is ready
-    while progressStatus != "complete" and progressStatus != "failed":
-        requestCheckUrl = baseUrl + progressId
-        requestCheckResponse = requests.request("GET", requestCheckUrl, headers=headers)
-        requestCheckProgress = requestCheckResponse.json()["result"]["percentComplete"]
-        progress(float(requestCheckProgress), 100.0, prefix="Progress\t\t")
-        progressStatus = requestCheckResponse.json()["result"]["status"]
+    requestCheck = wait_for_qualtrics_export(
+        baseUrl + progressId,
+        headers,
+        poll_interval=poll_interval,
+        max_poll_interval=max_poll_interval,
+        timeout=export_timeout,
+        showprogress=showprogress,
+    )
 
     # step 2.1: Check for error
-    if progressStatus == "failed":
+    if requestCheck["result"]["status"] == "failed":
         raise Exception(
-            f"export failed, HTTP Status {requestCheckResponse.json()['meta']['httpStatus']}"
+            f"export failed, HTTP Status {requestCheck['meta']['httpStatus']}"
         )
 
-    fileId = requestCheckResponse.json()["result"]["fileId"]
+    fileId = requestCheck["result"]["fileId"]
 
-    # Step 3: Downloading file
+    # Step 3: Downloading file into memory, spilling to a temporary file for large exports
     requestDownloadUrl = baseUrl + fileId + "/file"
-    requestDownload = requests.request(
-        "GET", requestDownloadUrl, headers=headers, stream=True
+    requestDownload = qualtrics_api_request(
+        "GET", requestDownloadUrl, headers, stream=True
     )
+    spooled = download_to_spooled_file(requestDownload)
+
+    # Step 4: Read file straight from the zip, only writing to disk if saveoutput
+    zip_responses = zipfile.ZipFile(spooled)
+    zip_responses_files = zip_responses.namelist()
+    if saveoutput:
+        # save files with date/timestamp
+        for file in zip_responses_files:
+            newname = (
+                ("" if fileprefix == None else fileprefix)
+                + os.path.splitext(os.path.basename(file))[0]
+                + f"_{time.strftime('%Y%m%d_T%H%M%S')}"
+                + "."
+                + fileformat
+            )
+            with zip_responses.open(file) as filein, open(
+                os.path.join(outputdirectory, newname), "wb"
+            ) as fileout:
+                shutil.copyfileobj(filein, fileout)
+            print(f"{newname} saved!")
+
+    # get the data from the last file in the export
+    member = zip_responses_files[-1]
+    if chunksize:
+        zip_responses.close()
+        return iter_qualtrics_export(spooled, member, fileformat, chunksize, encoding=encoding)
+    try:
+        df = read_qualtrics_export(zip_responses, member, fileformat, encoding=encoding)
+    finally:
+        zip_responses.close()
+        spooled.close()
+    return df
 
-    # Step 4: Extract file
-    # if (saveoutput == False) and ((fileformat == "csv") or (fileformat == "tsv")):
-    #     # print(io.BytesIO(requestDownload.content))
-    #     with zipfile.ZipFile(io.BytesIO(requestDownload.content)) as survey_zip:
-    #         for s in survey_zip.namelist():
-    #             print(s)
-    #             # print(survey_zip)
-    #             # save file in memory to dataframe.
-    #             # with survey_zip.open(s) as f:
-    #             # with survey_zip.read(s) as f:
-    #             # f = io.BytesIO(survey_zip.read(s))
-    #             f = io.BytesIO(requestDownload.content)
-    #             f.seek(0)
-    #             # # print(f)
-    #             df = pd.read_csv(f, sep=("\t" if fileformat == "tsv" else ","))
-    #     return df
-    # else:
-    # Unzipping the file
-    # zip_responses = zipfile.ZipFile(io.BytesIO(requestDownload.content))
-    # get file names from zip directory
-    zip_responses_files = zipfile.ZipFile(
-        io.BytesIO(requestDownload.content)
-    ).namelist()
-    # extract files
-    # zip_responses.extractall("MyQualtricsDownload")
-    zipfile.ZipFile(io.BytesIO(requestDownload.content)).extractall(outputdirectory)
-    # zip_responses.extractall(outputdirectory)
-
-    # rename files with date/timestamp
-    newname = ""
-    new_files = []
-    for file in zip_responses_files:
-        newname = (
-            ("" if fileprefix == None else fileprefix)
-            + os.path.splitext(os.path.basename(os.path.join(outputdirectory, file)))[0]
-            + f"_{time.strftime('%Y%m%d_T%H%M%S')}"
-            + "."
-            + fileformat
-        )
-        os.rename(
-            os.path.join(outputdirectory, file), os.path.join(outputdirectory, newname)
-        )
-        print(f"{newname} saved!")
-        new_files.append(newname)
-    # print('Complete')
-
-    # get the file and read the data
-    fileformatSep = "\t" if fileformat == "tsv" else ","
-    print(os.path.join(outputdirectory, newname))
-    df = pd.read_table(
-        os.path.join(outputdirectory, newname),
-        sep=fileformatSep,
-        header=0,
-        encoding="UTF-16",
+
+# ============================================================================ #
+#                     concurrent multi-survey response export                  #
+# ============================================================================ #
+# default limits for get_all_qualtrics_survey_responses
+QUALTRICS_EXPORT_WORKERS = 4
+QUALTRICS_REQUESTS_PER_SECOND = 5
+
+
+def get_all_qualtrics_survey_responses(
+    token,
+    datacenter,
+    surveyids,
+    workers=QUALTRICS_EXPORT_WORKERS,
+    requests_per_second=QUALTRICS_REQUESTS_PER_SECOND,
+    **kwargs,
+):
+    """Export responses for several surveys at once.
+    Up to `workers` exports are started, polled and downloaded at the same time, and all API requests share a limit
+    of `requests_per_second`. Each survey is read into pandas as soon as its export completes.
+    Other keyword arguments are passed to get_qualtrics_survey_responses.
+
+    Args:
+        surveyids (list | dict): Qualtrics survey IDs, or labels mapped to survey IDs as in the survey import config
+
+    Returns:
+        tuple(dict, dict): responses as {label: DataFrame}, and errors as {label: error message} for failed surveys
+    """
+    if not isinstance(surveyids, dict):
+        surveyids = {surveyid: surveyid for surveyid in surveyids}
+
+    responses = {}
+    errors = {}
+    previous_rate_limit = _qualtrics_rate_limit
+    set_qualtrics_rate_limit(requests_per_second)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            future_to_label = {
+                executor.submit(
+                    get_qualtrics_survey_responses,
+                    token,
+                    datacenter,
+                    surveyid,
+                    showprogress=False,
+                    **kwargs,
+                ): label
+                for label, surveyid in surveyids.items()
+            }
+            for future in as_completed(future_to_label):
+                label = future_to_label[future]
+                try:
+                    responses[label] = future.result()
+                    print(f"{label} ({surveyids[label]}): {len(responses[label])} rows")
+                # get_qualtrics_survey_responses exits on invalid inputs, which should only fail that survey
+                except (Exception, SystemExit) as err:
+                    errors[label] = f"{type(err).__name__}: {err}"
+                    print(f"{label} ({surveyids[label]}): FAILED {errors[label]}")
+    finally:
+        set_qualtrics_rate_limit(previous_rate_limit)
+
+    return responses, errors
+
+
+# ============================================================================ #
+#                       incremental survey response sync                       #
+# ============================================================================ #
+QUALTRICS_SYNC_STATE_FILE = "qualtrics_sync_state.json"
+
+
+def load_sync_state(statefile):
+    if not os.path.exists(statefile):
+        return {}
+    with open(statefile) as f:
+        return json.load(f)
+
+
+def save_sync_state(statefile, state):
+    # write to a temporary file first, so an interrupted run cannot corrupt the state
+    tmpfile = statefile + ".tmp"
+    with open(tmpfile, "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmpfile, statefile)
+
+
+def save_sync_watermark(statefile, surveyid, watermark):
+    """Record the watermark returned by sync_qualtrics_survey_responses, once its responses are stored"""
+    if watermark is None:
+        return
+    state = load_sync_state(statefile)
+    state[surveyid] = watermark
+    save_sync_state(statefile, state)
+
+
+def qualtrics_recorded_date(recorded):
+    """ISO 8601 startDate for a naive RecordedDate, which qualtrics exports in QUALTRICS_TIMEZONE.
+    In the repeated fall-back hour the earlier (daylight) time is used, so the next pull starts early rather than
+    skipping responses. Times skipped by the spring-forward change are moved to the end of the gap.
+    """
+    return recorded.tz_localize(
+        QUALTRICS_TIMEZONE, ambiguous=True, nonexistent="shift_forward"
+    ).isoformat()
+
+
+def drop_synced_responses(df, watermark):
+    """Drop responses seen in the previous pull (by ResponseId) and repeated ResponseIds. Header rows are kept"""
+    # exports include header rows (question text, import ids) that are not responses
+    isresponse = df["ResponseId"].astype(str).str.match(r"^R_")
+    isnew = ~df["ResponseId"].isin(watermark.get("ResponseIds", [])) & ~(
+        isresponse & df["ResponseId"].duplicated()
     )
+    return df[~isresponse | isnew]
 
-    if saveoutput == False or saveoutput is None:
-        os.remove(os.path.join(outputdirectory, newname))
-        return df
-    else:
-        # return new_files
-        return df
+
+def next_sync_watermark(responses, watermark):
+    """Watermark after `responses`: their latest RecordedDate and the ResponseIds recorded at that time.
+    Returns None when no RecordedDate could be read.
+    """
+    recorded = pd.to_datetime(responses["RecordedDate"], errors="coerce")
+    latest = recorded.max()
+    if pd.isna(latest):
+        return None
+    # keep ids recorded at the latest time, they are returned again by the next export
+    latestids = responses.loc[recorded == latest, "ResponseId"].tolist()
+    recordeddate = qualtrics_recorded_date(latest)
+    if watermark.get("RecordedDate") == recordeddate:
+        latestids = watermark.get("ResponseIds", []) + latestids
+    return {
+        "RecordedDate": recordeddate,
+        "ResponseIds": latestids,
+        "LastSync": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def sync_qualtrics_survey_responses(
+    token,
+    datacenter,
+    surveyid,
+    statefile=None,
+    fileformat="tsv",
+    outputdirectory="MyQualtricsDownloads",
+    **kwargs,
+):
+    """Export only the responses recorded since the last sync of this survey.
+
+    The high-water mark (latest RecordedDate, and the ResponseIds recorded at that time) is kept per survey in
+    `statefile`, which defaults to QUALTRICS_SYNC_STATE_FILE in `outputdirectory`. The next pull starts at that
+    RecordedDate, and responses seen in the previous pull are dropped by ResponseId.
+    The state file is not changed here: store the responses (i.e. with save_synced_responses), then pass the returned
+    watermark to save_sync_watermark, so responses are never marked synced before they are kept.
+    Other keyword arguments are passed to get_qualtrics_survey_responses, except `chunksize` and `saveoutput`:
+    the whole export is needed to drop synced responses, and the raw export still has them.
+
+    Returns:
+        tuple: (pd.DataFrame of new survey responses, header rows from the export are kept;
+            new watermark for save_sync_watermark, None when there are no new responses)
+    """
+    for option in ["chunksize", "saveoutput"]:
+        if kwargs.get(option):
+            raise ValueError(
+                f"'{option}' is not supported by sync_qualtrics_survey_responses, save the returned responses with save_synced_responses"
+            )
+    kwargs.pop("saveoutput", None)
+    kwargs.pop("chunksize", None)
+
+    if statefile is None:
+        statefile = os.path.join(outputdirectory, QUALTRICS_SYNC_STATE_FILE)
+    watermark = load_sync_state(statefile).get(surveyid, {})
+
+    df = get_qualtrics_survey_responses(
+        token,
+        datacenter,
+        surveyid,
+        fileformat=fileformat,
+        outputdirectory=outputdirectory,
+        startdate=watermark.get("RecordedDate"),
+        **kwargs,
+    )
+
+    df = drop_synced_responses(df, watermark)
+    responses = df[df["ResponseId"].astype(str).str.match(r"^R_")]
+    print(f"\n{len(responses)} new responses for {surveyid}")
+
+    newwatermark = None
+    if not responses.empty:
+        newwatermark = next_sync_watermark(responses, watermark)
+
+    return df, newwatermark
+
+
+def save_synced_responses(
+    df,
+    surveyid,
+    fileformat="tsv",
+    outputdirectory="MyQualtricsDownloads",
+    fileprefix=None,
+    encoding=QUALTRICS_EXPORT_ENCODING,
+):
+    """Write the responses returned by sync_qualtrics_survey_responses to `outputdirectory`, in the same format
+    and encoding they were read with. Nothing is written when there are no responses.
+
+    Returns:
+        str: path of the saved file, None if nothing was written
+    """
+    if fileformat not in ["csv", "tsv"]:
+        raise ValueError(f"synced responses can be saved as csv or tsv, not '{fileformat}'")
+    if not df["ResponseId"].astype(str).str.match(r"^R_").any():
+        return None
+    options = qualtrics_export_read_options(fileformat)
+    newname = (
+        ("" if fileprefix == None else fileprefix)
+        + surveyid
+        + f"_{time.strftime('%Y%m%d_T%H%M%S')}"
+        + "."
+        + fileformat
+    )
+    outputfile = os.path.join(outputdirectory, newname)
+    # write to a temporary file first, so a partial file is never left with the synced name
+    tmpfile = outputfile + ".tmp"
+    df.to_csv(tmpfile, sep=options["sep"], encoding=encoding, index=False)
+    os.replace(tmpfile, outputfile)
+    print(f"{newname} saved!")
+    return outputfile
+
+
+# downloads larger than this (bytes) are spooled to a temporary file instead of kept in memory
+QUALTRICS_DOWNLOAD_SPOOL_SIZE = 64 * 1024 * 1024
+
+
+def download_to_spooled_file(response, chunk_size=1024 * 1024):
+    """Stream a download into a SpooledTemporaryFile, returned at position 0"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=QUALTRICS_DOWNLOAD_SPOOL_SIZE)
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def qualtrics_export_read_options(fileformat):
+    return {
+        "sep": "\t" if fileformat == "tsv" else ",",
+        "header": 0,
+    }
+
+
+def read_qualtrics_export(zip_responses, member, fileformat, encoding=QUALTRICS_EXPORT_ENCODING):
+    """Decode one file of a response export zip into a DataFrame without extracting it"""
+    options = qualtrics_export_read_options(fileformat)
+    with zip_responses.open(member) as f:
+        return pd.read_csv(io.TextIOWrapper(f, encoding=encoding), **options)
+
+
+def iter_qualtrics_export(spooled, member, fileformat, chunksize, encoding=QUALTRICS_EXPORT_ENCODING):
+    """Yield DataFrames of `chunksize` rows from one file of a response export zip.
+    The spooled download is closed once the last chunk is read.
+    """
+    options = qualtrics_export_read_options(fileformat)
+    with spooled, zipfile.ZipFile(spooled) as zip_responses, zip_responses.open(
+        member
+    ) as f:
+        yield from pd.read_csv(
+            io.TextIOWrapper(f, encoding=encoding), chunksize=chunksize, **options
+        )
 
 
 def progress(progress_val, total, prefix=""):
@@ -944,6 +1553,11 @@ def field_type_lookup(question):
         # "checkbox": "varchar(255)",
     }
     field_type = field_type_lookup[question["QuestionType"]]
+    # same SQL to PHP element mapping as the instrument templates
+    if sql_to_php_field_type(field_type, default=None) is None:
+        print(
+            f"WARNING: question {question.get('Tag')} has SQL type '{field_type}', which has no LORIS form element"
+        )
     return field_type
 
 
@@ -1003,8 +1617,42 @@ def main():
                 lastpulldate=args.lastpulldate,
                 outputdirectory=args.output_dir,
                 saveoutput=args.saveoutput,
+                max_poll_interval=args.max_poll_interval,
+                export_timeout=args.export_timeout,
             )
             # out = func(args.apitoken, args.datacenter, args.surveyid, fileFormat = fileformat, lastpulldate = lastpulldate, )
+        elif args.command in ["get_all_survey_responses"]:
+            out = get_all_qualtrics_survey_responses(
+                args.apitoken,
+                args.datacenter,
+                args.surveyid.split(","),
+                workers=args.workers,
+                fileformat=args.fileformat,
+                lastpulldate=args.lastpulldate,
+                outputdirectory=args.output_dir,
+                saveoutput=args.saveoutput,
+                max_poll_interval=args.max_poll_interval,
+                export_timeout=args.export_timeout,
+            )
+        elif args.command in ["sync_survey_responses"]:
+            statefile = (
+                args.statefile
+                if args.statefile != None
+                else os.path.join(args.output_dir, QUALTRICS_SYNC_STATE_FILE)
+            )
+            out, watermark = sync_qualtrics_survey_responses(
+                args.apitoken,
+                args.datacenter,
+                args.surveyid,
+                statefile=statefile,
+                fileformat=args.fileformat,
+                outputdirectory=args.output_dir,
+                max_poll_interval=args.max_poll_interval,
+                export_timeout=args.export_timeout,
+            )
+            # always save the new responses, they are only marked synced once they are written to --output_dir
+            save_synced_responses(out, args.surveyid, args.fileformat, args.output_dir)
+            save_sync_watermark(statefile, args.surveyid, watermark)
         elif args.command in [
             "get_survey_questions",
             "get_all_survey_questions",
@@ -1028,6 +1676,8 @@ function_map = {
     "get_question_tags": get_question_tags,
     "convert_survey": get_metadata_from_survey,
     "get_survey_responses": get_qualtrics_survey_responses,
+    "sync_survey_responses": sync_qualtrics_survey_responses,
+    "get_all_survey_responses": get_all_qualtrics_survey_responses,
 }
 
 
@@ -1052,7 +1702,17 @@ def parse_args():
         help="Call a specific function from qualtrics.py file",
     )
     parser.add_argument(
-        "--surveyid", type=str, dest="surveyid", help="Qualtrics survey ID"
+        "--surveyid",
+        type=str,
+        dest="surveyid",
+        help="Qualtrics survey ID. For get_all_survey_responses, a comma separated list of survey IDs",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        dest="workers",
+        default=QUALTRICS_EXPORT_WORKERS,
+        help=f"Number of surveys exported at the same time by get_all_survey_responses. Defaults to {QUALTRICS_EXPORT_WORKERS}.",
     )
     parser.add_argument(
         "--datacenter", type=str, dest="datacenter", help="Qualtrics datacenter"
@@ -1088,6 +1748,27 @@ def parse_args():
         type=directory,
         help="Valid file path to output directory.",
     )
+    parser.add_argument(
+        "--statefile",
+        type=str,
+        dest="statefile",
+        default=None,
+        help=f"JSON file with the last synced response for each survey, used by sync_survey_responses (which always saves the responses to --output_dir). Defaults to '{QUALTRICS_SYNC_STATE_FILE}' in --output_dir.",
+    )
+    parser.add_argument(
+        "--max_poll_interval",
+        type=float,
+        dest="max_poll_interval",
+        default=QUALTRICS_MAX_POLL_INTERVAL,
+        help=f"Longest wait in seconds between export progress checks when pulling qualtrics responses. Defaults to {QUALTRICS_MAX_POLL_INTERVAL}.",
+    )
+    parser.add_argument(
+        "--export_timeout",
+        type=float,
+        dest="export_timeout",
+        default=QUALTRICS_EXPORT_TIMEOUT,
+        help=f"Seconds to wait for a qualtrics response export to finish before giving up. Defaults to {QUALTRICS_EXPORT_TIMEOUT}.",
+    )
     parser.add_argument(
         "--saveoutput",
         dest="saveoutput",
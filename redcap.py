@@ -1,8 +1,10 @@
 import requests
 import json
 import configparser
+import hashlib
 import pandas as pd
 import os
+from generate_instrument import sql_to_php_field_type
 
 def get_metadata(redcap_config = os.path.join('config','redcap_config.ini'), db = 'redcap'):
     '''
@@ -46,6 +48,61 @@ def get_metadata(redcap_config = os.path.join('config','redcap_config.ini'), db
 
     return result
 
+# column headers of a REDCap data dictionary csv export, mapped to the metadata keys returned by the API
+DATA_DICTIONARY_COLUMNS = {
+    'Variable / Field Name': 'field_name',
+    'Form Name': 'form_name',
+    'Section Header': 'section_header',
+    'Field Type': 'field_type',
+    'Field Label': 'field_label',
+    'Choices, Calculations, OR Slider Labels': 'select_choices_or_calculations',
+    'Field Note': 'field_note',
+    'Text Validation Type OR Show Slider Number': 'text_validation_type_or_show_slider_number',
+    'Text Validation Min': 'text_validation_min',
+    'Text Validation Max': 'text_validation_max',
+    'Identifier?': 'identifier',
+    'Branching Logic (Show field only if...)': 'branching_logic',
+    'Required Field?': 'required_field',
+    'Custom Alignment': 'custom_alignment',
+    'Question Number (surveys only)': 'question_number',
+    'Matrix Group Name': 'matrix_group_name',
+    'Matrix Ranking?': 'matrix_ranking',
+    'Field Annotation': 'field_annotation',
+}
+
+# converted instruments from local data dictionaries, keyed by a hash of the file contents
+REDCAP_DICTIONARY_CACHE_DIR = '.redcap_cache'
+# hash of this module's source, so cache files written by older conversion code are not reused
+with open(__file__, 'rb') as f:
+    REDCAP_DICTIONARY_CACHE_VERSION = hashlib.sha256(f.read()).hexdigest()
+
+def read_data_dictionary(path):
+    """
+    Reads a REDCap data dictionary export from a local file, instead of the API. See get_metadata
+
+    Arguments
+    ----------
+    path: string
+        path to a data dictionary csv export, or a json metadata export (`content=metadata`)
+
+    Returns
+    ----------
+    metadata: list of dictionaries
+        metadata in the same format as get_metadata, one dictionary per field
+    """
+    if os.path.splitext(path)[1].lower() == '.json':
+        with open(path) as f:
+            metadata = json.load(f)
+    else:
+        # read every column as text, so empty cells are '' like the API and codes keep leading zeros
+        data_dictionary = pd.read_csv(path, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+        data_dictionary = data_dictionary.rename(columns=DATA_DICTIONARY_COLUMNS)
+        metadata = data_dictionary.to_dict(orient='records')
+
+    if not isinstance(metadata, list) or (metadata and 'field_name' not in metadata[0]):
+        raise RuntimeError(f"{path} is not a REDCap data dictionary. Expected a csv export or a json list of fields.")
+    return metadata
+
 def metadata_to_dict(metadata):
     """
     transforms metadata from REDCap into a dictionary with a key for each form.
@@ -57,8 +114,11 @@ def metadata_to_dict(metadata):
     """
     include = generate_filtered_data_dict(metadata)
 
-    filtered_metadata = [metadata for metadata in metadata if metadata["field_name"] in include]
-    sorted_metadata = {metadata["form_name"]: {field["field_name"]: field for field in filtered_metadata if field["form_name"] == metadata["form_name"]} for metadata in filtered_metadata}
+    # group the included fields by form in one pass, keeping the data dictionary order of forms and fields
+    sorted_metadata = {}
+    for field in metadata:
+        if field["field_name"] in include:
+            sorted_metadata.setdefault(field["form_name"], {})[field["field_name"]] = field
 
     # if verbose:
     #     with open(f'outputs/json/sortedMetadata.json', 'w+') as file:
@@ -76,24 +136,29 @@ def generate_filtered_data_dict(metadata):
 
     Returns
     ----------
-    fields_to_include: list of strings
-        a list of the fields that should be pulled from REDCap.
+    fields_to_include: set of strings
+        the fields that should be pulled from REDCap.
     """
 
     include = ["date_mdy", "datetime_mdy", "integer", "number", "time"]
 
-    metadata_df = pd.read_json(json.dumps(metadata))
-
-    metadata_df.drop(metadata_df.loc[metadata_df['field_type']=='descriptive'].index, inplace=True)
-    metadata_df.drop(metadata_df.loc[metadata_df['field_type']=='notes'].index, inplace=True)
-    metadata_df.drop(metadata_df.loc[metadata_df['identifier']=='y'].index, inplace=True)
+    metadata_df = pd.DataFrame.from_records(
+        metadata,
+        columns=['field_name', 'field_type', 'identifier', 'text_validation_type_or_show_slider_number']
+    )
+    field_type = metadata_df['field_type']
 
-    metadata_df.drop(metadata_df.loc[(metadata_df['field_type']=='text') & (~metadata_df['text_validation_type_or_show_slider_number'].isin(include))].index, inplace=True)
+    # drop descriptive and notes fields, identifiers, and text fields without a date/number validation in one mask
+    keep = (
+        ~field_type.isin(['descriptive', 'notes'])
+        & (metadata_df['identifier'] != 'y')
+        & ~((field_type == 'text') & ~metadata_df['text_validation_type_or_show_slider_number'].isin(include))
+    )
 
     # if verbose:
-    #     metadata_df.to_csv("outputs/filtered_data_dictionary.csv", index=False)
-    
-    fields_to_include = metadata_df['field_name'].to_list()
+    #     metadata_df[keep].to_csv("outputs/filtered_data_dictionary.csv", index=False)
+
+    fields_to_include = set(metadata_df.loc[keep, 'field_name'])
 
     return fields_to_include
 
@@ -130,6 +195,9 @@ def field_type_lookup(question):
             'checkbox':'varchar(255)'
             }
         field_type = field_type_lookup[question['field_type']]
+    # same SQL to PHP element mapping as the instrument templates
+    if sql_to_php_field_type(field_type, default=None) is None:
+        print(f"WARNING: field {question['field_name']} has SQL type '{field_type}', which has no LORIS form element")
     return field_type
 
 def make_enum_array(question):
@@ -213,17 +281,61 @@ def metadata_to_instrument_json(metadata, form):
     # print(json.dumps(instrument_data, indent=4))
     return instrument_data
 
-def all_metadata_to_instrument_jsons():
+def all_metadata_to_instrument_jsons(metadata=None):
     """
     creates an instrument builder dictionary for all REDCap forms in sorted_metadata
 
+    Arguments
+    ----------
+    metadata: list of dictionaries
+        REDCap metadata, see read_data_dictionary. Pulled from the API with get_metadata when None
+
     Returns
     ----------
     instruments: list of dictionaries
         a list of dictionaires accepted by the instrument builder
     """
-    metadata = metadata_to_dict(get_metadata())
+    metadata = metadata_to_dict(get_metadata() if metadata is None else metadata)
 
     instruments = [metadata_to_instrument_json(metadata, instrument) for instrument in metadata.keys()]
     # print(json.dumps(instruments, indent=4))
     return instruments
+
+def data_dictionary_to_instrument_jsons(path, cachedir=REDCAP_DICTIONARY_CACHE_DIR):
+    """
+    creates instrument builder dictionaries from a local REDCap data dictionary, without connecting to REDCap.
+    The converted instruments are cached in `cachedir` by the hash of the file contents and of the conversion code, so an unchanged file is not converted again.
+
+    Arguments
+    ----------
+    path: string
+        path to a data dictionary csv or json export, see read_data_dictionary
+    cachedir: string
+        directory for cached instruments. No cache is used when None
+
+    Returns
+    ----------
+    instruments: list of dictionaries
+        a list of dictionaires accepted by the instrument builder
+    """
+    digest = hashlib.sha256(REDCAP_DICTIONARY_CACHE_VERSION.encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    cachefile = os.path.join(cachedir, f'{digest.hexdigest()}.json') if cachedir is not None else None
+
+    if cachefile is not None and os.path.exists(cachefile):
+        print(f'Using cached instruments for {path}')
+        with open(cachefile) as f:
+            return json.load(f)
+
+    instruments = all_metadata_to_instrument_jsons(read_data_dictionary(path))
+
+    if cachefile is not None:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        # write to a temporary file first, so an interrupted run cannot leave a partial cache file
+        with open(cachefile + '.tmp', 'w') as f:
+            json.dump(instruments, f)
+        os.replace(cachefile + '.tmp', cachefile)
+    return instruments
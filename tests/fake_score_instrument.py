@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+"""Stands in for LORIS tools/data_integrity/score_instrument.php in tests.
+
+Called like score_instrument.php: fake_score_instrument.py <test> one <candidateID> <sessionID>
+Candidates starting with "fail" exit with 1 and an error on stderr, "slow" candidates sleep for 2 seconds.
+"""
+import sys
+import time
+
+test, mode, candidateID, sessionID = sys.argv[1:5]
+if candidateID.startswith("slow"):
+    time.sleep(2)
+if candidateID.startswith("fail"):
+    print(f"ERROR: no {test} instrument for candidate {candidateID} session {sessionID}", file=sys.stderr)
+    sys.exit(1)
+print(f"Scored {test} ({mode}) for candidate {candidateID} session {sessionID}")
@@ -0,0 +1,41 @@
+import unittest
+
+from generate_instrument import convert_instrument_template, get_template, sql_to_php_field_type
+
+# NOTE: from command line in LORIS_instrument_builder directory run: python -m unittest -v tests/test_generate_instrument.py
+
+TYPED_INSTRUMENT = {
+    "instrument_name_sql": "typed",
+    "fields": {
+        f"field{i}": {"field_name_sql": f"q{i}", "field_front_text_php": f"Question {i}", "field_type_sql": sqltype, "page_php": 0, "group_php": False}
+        for i, sqltype in enumerate(["decimal(5,2)", "int(11)", "varchar(255)", "text", "date", "header"])
+    },
+}
+
+
+class TestFieldTypes(unittest.TestCase):
+    def test_01_sql_to_php_field_type(self):
+        """Check parameterized and upper case SQL types resolve to their PHP element type"""
+        self.assertEqual(sql_to_php_field_type("DECIMAL(5,2)"), "text")
+        self.assertEqual(sql_to_php_field_type("int unsigned"), "text")
+        self.assertEqual(sql_to_php_field_type("longtext"), "textarea")
+        self.assertEqual(sql_to_php_field_type("enum"), "select")
+        self.assertEqual(sql_to_php_field_type("header"), "static")
+        self.assertIsNone(sql_to_php_field_type("header", default=None))
+
+    def test_02_ungrouped_fields(self):
+        """Check ungrouped fields get the same PHP element type as grouped fields, and are rendered"""
+        fields = convert_instrument_template(TYPED_INSTRUMENT)["fields"]
+        self.assertEqual(
+            [field["field_type_php"] for field in fields.values()],
+            ["text", "text", "text", "textarea", "date", None],
+        )
+        php = get_template("LORIS_instrument_builder_php_template.html.jinja2").render(convert_instrument_template(TYPED_INSTRUMENT))
+        self.assertIn("$this->form->addElement('text','q0',\"Question 0\");", php)
+        self.assertIn("$this->form->addElement('text','q1',\"Question 1\");", php)
+        self.assertIn("$this->addTextAreaElement('q3',\"Question 3\");", php)
+        self.assertIn("$this->addBasicDate('q4', \"Question 4\");", php)
+
+
+if __name__ == "__main__":
+    unittest.main()
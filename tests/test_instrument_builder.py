@@ -0,0 +1,88 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import instrument_builder
+from instrument_builder import build_all_qualtrics_surveys
+from validate import valid_config_section
+
+# NOTE: from command line in LORIS_instrument_builder directory run: python -m unittest -v tests/test_instrument_builder.py
+
+SURVEY_CONFIG = """[study1]
+id_slow = SV_slow
+notes = not a survey
+id_bad = SV_bad
+id_fast = SV_fast
+
+[study2]
+id_other = SV_other
+"""
+
+
+def fake_metadata_from_survey(token, datacenter, surveyid, cachedir=None, offline=False, stream=False):
+    """Stand-in for qualtrics.get_metadata_from_survey: SV_slow finishes last, SV_bad fails"""
+    if surveyid == "SV_slow":
+        time.sleep(0.3)
+    if surveyid == "SV_bad":
+        raise RuntimeError("API request failed: 404")
+    return {"instrument_name_sql": surveyid.lower(), "fields": {}}
+
+
+class TestConfigSection(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_file = os.path.join(self.tmpdir.name, "qualtrics_survey_import_config.ini")
+        with open(self.config_file, "w") as f:
+            f.write(SURVEY_CONFIG)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_prefix(self):
+        """Check only the `id_` labels of the section are returned, in config order"""
+        self.assertEqual(
+            valid_config_section(self.config_file, "study1", prefix="id_"),
+            {"id_slow": "SV_slow", "id_bad": "SV_bad", "id_fast": "SV_fast"},
+        )
+        self.assertEqual(len(valid_config_section(self.config_file, "study1")), 4)
+        with self.assertRaises(NameError):
+            valid_config_section(self.config_file, "study3", prefix="id_")
+
+
+class TestBuildAllQualtricsSurveys(unittest.TestCase):
+    def build(self, surveys, workers=3):
+        self.generated = []
+        lock = threading.Lock()
+
+        def generate(instrument, output_dir, templates_dir=None):
+            with lock:
+                self.generated.append(instrument["instrument_name_sql"])
+
+        with mock.patch.object(instrument_builder, "get_metadata_from_survey", side_effect=fake_metadata_from_survey), mock.patch.object(
+            instrument_builder, "generate_instrument_from_template", side_effect=generate
+        ):
+            return build_all_qualtrics_surveys("token", "dc", surveys, "outputs", workers=workers)
+
+    def test_01_failed_survey(self):
+        """Check one failed survey is reported without stopping the rest of the batch"""
+        results = self.build({"id_slow": "SV_slow", "id_bad": "SV_bad", "id_fast": "SV_fast"})
+        self.assertEqual(results["id_slow"], (True, "slow"))
+        self.assertEqual(results["id_fast"], (True, "fast"))
+        self.assertEqual(results["id_bad"], (False, "RuntimeError: API request failed: 404"))
+        self.assertEqual(sorted(self.generated), ["fast", "slow"])
+
+    def test_02_config_order(self):
+        """Check results come back in config order, not in the order the surveys finish"""
+        results = self.build({"id_slow": "SV_slow", "id_bad": "SV_bad", "id_fast": "SV_fast"})
+        self.assertEqual(list(results), ["id_slow", "id_bad", "id_fast"])
+        # the slow survey finished last
+        self.assertEqual(self.generated, ["fast", "slow"])
+        results = self.build({"id_fast": "SV_fast", "id_slow": "SV_slow"}, workers=1)
+        self.assertEqual(list(results), ["id_fast", "id_slow"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+import csv
+import importlib.util
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "E-Lab"))
+
+from json_data_import import (
+    execute_instrument_updates,
+    import_data_export,
+    iter_import_data,
+    map_import_data,
+    resolve_commentids,
+)
+
+# NOTE: from command line in LORIS_instrument_builder directory run: python -m unittest -v tests/test_json_data_import.py
+# To also run the update tests against MariaDB, start a local container and set LORIS_TEST_MARIADB:
+#   docker run --rm -d -p 3306:3306 -e MARIADB_ROOT_PASSWORD=test -e MARIADB_DATABASE=loris_test mariadb:10.11
+#   LORIS_TEST_MARIADB=127.0.0.1:3306:root:test:loris_test python -m unittest -v tests/test_json_data_import.py
+
+LORISMAP = [
+    {
+        "Test_name": "vineland3",
+        "Filters": [
+            {"Field": "PSCID", "External Field": "ExamineeID", "Fixed Value": None, "Operator": "like"},
+            {"Field": "Visit_label", "External Field": "LastName", "Fixed Value": None, "Operator": "equivalent"},
+        ],
+    },
+    {"Field": "Date_taken", "External Field": "DateTaken", "External Conversion": "date", "Null": "YES"},
+    {"Field": "score", "External Field": "Score", "External Conversion": None, "Null": "YES"},
+    {"Field": "comments", "External Field": None, "External Conversion": None, "Null": "YES"},
+]
+
+LORIS_TABLES = [
+    "CREATE TABLE candidate (CandID INTEGER, PSCID VARCHAR(255))",
+    "CREATE TABLE session (ID INTEGER, CandID INTEGER, Visit_label VARCHAR(255), Date_visit DATE)",
+    "CREATE TABLE flag (SessionID INTEGER, CommentID VARCHAR(255), Test_name VARCHAR(255), Data_entry VARCHAR(255), Administration VARCHAR(255))",
+    "CREATE TABLE vineland3 (CommentID VARCHAR(255), Date_taken DATE, Data_entry_completion_status VARCHAR(255), examiner INTEGER, score INTEGER CHECK (score >= 0))",
+    "INSERT INTO candidate VALUES (1, 'AIS1001'), (2, 'AIS1002'), (3, 'AIS10021')",
+    "INSERT INTO session VALUES (10, 1, 'agccx12m', '2021-05-26'), (20, 2, 'agccx12m', '2021-06-01'), (30, 3, 'agccx12m', '2021-06-02')",
+    "INSERT INTO flag VALUES (10, 'c1', 'vineland3', NULL, NULL), (10, 'DDE_c1', 'vineland3', NULL, NULL), (20, 'c2', 'vineland3', NULL, NULL), (30, 'c3', 'vineland3', NULL, NULL)",
+    "INSERT INTO vineland3 (CommentID) VALUES ('c1'), ('DDE_c1'), ('c2'), ('c3')",
+]
+
+UPDATE_ROWS = [
+    {"ExamineeID": "AIS1001", "LastName": "agccx12m", "DateTaken": "05/26/2021", "Score": "12"},
+    {"ExamineeID": "AIS1002", "LastName": "agccx12m", "DateTaken": "06/01/2021", "Score": "3"},  # ambiguous
+    {"ExamineeID": "AIS10021", "LastName": "agccx12m", "DateTaken": "06/02/2021", "Score": "-1"},  # fails CHECK
+    {"ExamineeID": "AIS1001", "LastName": "agccx12m", "DateTaken": "", "Score": ""},  # c1 again in the same import
+]
+
+
+def loris_database(cnx=None):
+    """Database with the candidate, session, flag and instrument tables used by the import. In-memory sqlite by default"""
+    cnx = cnx if cnx is not None else sqlite3.connect(":memory:")
+    cursor = cnx.cursor()
+    for statement in LORIS_TABLES:
+        cursor.execute(statement)
+    cnx.commit()
+    cursor.close()
+    return cnx
+
+
+class TestMappingPlan(unittest.TestCase):
+    def test_01_map_import_data(self):
+        """Check filter keys, NULL rules and date conversion are applied to every row at once"""
+        mapped = map_import_data(LORISMAP, UPDATE_ROWS)
+        self.assertEqual(list(mapped.columns), ["candidate", "visit", "visit_date", "Date_taken", "score", "Mapping Error"])
+        self.assertEqual(list(mapped["candidate"]), ["AIS1001%", "AIS1002%", "AIS10021%", "AIS1001%"])
+        self.assertEqual(list(mapped["Date_taken"]), ["2021-05-26", "2021-06-01", "2021-06-02", None])
+        self.assertEqual(list(mapped["score"]), ["12", "3", "-1", None])
+        self.assertEqual(list(mapped["visit_date"]), [None] * 4)
+        self.assertEqual(list(mapped["Mapping Error"]), [""] * 4)
+
+    def test_02_fixed_value_and_candid(self):
+        """Check a CandID filter overrides PSCID, and Fixed Value is used for every row"""
+        lorismap = [
+            {
+                "Test_name": "vineland3",
+                "Filters": [
+                    {"Field": "PSCID", "External Field": "ExamineeID", "Fixed Value": None, "Operator": "like"},
+                    {"Field": "CandID", "External Field": "CandID", "Fixed Value": None, "Operator": "equivalent"},
+                    {"Field": "Visit_label", "External Field": None, "Fixed Value": "agccx12m", "Operator": "equivalent"},
+                ],
+            }
+        ]
+        mapped = map_import_data(lorismap, [{"ExamineeID": "AIS1001", "CandID": "300001"}])
+        self.assertEqual(mapped.iloc[0].tolist(), ["300001", "agccx12m", None, ""])
+
+    def test_03_malformed_date(self):
+        """Check a date in another format is mapped to None and reported, instead of raising"""
+        datarows = [dict(UPDATE_ROWS[0]), dict(UPDATE_ROWS[1], DateTaken="2021-06-02")]
+        mapped = map_import_data(LORISMAP, datarows)
+        self.assertEqual(list(mapped["Date_taken"]), ["2021-05-26", None])
+        self.assertEqual(mapped.at[0, "Mapping Error"], "")
+        self.assertIn("2021-06-02", mapped.at[1, "Mapping Error"])
+
+
+class TestResolveCommentIDs(unittest.TestCase):
+    def test_01_resolve(self):
+        """Check resolved, missing and ambiguous rows, across several batches"""
+        datarows = [
+            {"ExamineeID": "AIS1001", "LastName": "agccx12m"},
+            {"ExamineeID": "AIS1002", "LastName": "agccx12m"},  # AIS1002% also matches AIS10021
+            {"ExamineeID": "AIS1001", "LastName": "agccx24m"},
+            {"ExamineeID": "AIS10021", "LastName": "agccx12m"},
+        ]
+        commentids, unresolved = resolve_commentids(loris_database(), LORISMAP, datarows, batch_size=3)
+        self.assertEqual(list(commentids["CommentID Status"]), ["y", "m", "n", "y"])
+        self.assertEqual(list(commentids["CommentID"]), ["c1", "", "", "c3"])
+        self.assertEqual(list(commentids["matches"]), [1, 2, 0, 1])
+        self.assertEqual(list(unresolved.index), [1, 2])
+        self.assertEqual(unresolved.at[1, "candidate"], "AIS1002%")
+
+
+
+class TestExecuteInstrumentUpdates(unittest.TestCase):
+    def connect(self):
+        return loris_database()
+
+    def setUp(self):
+        self.cnx = self.connect()
+
+    def tearDown(self):
+        self.cnx.close()
+
+    def select(self, statement):
+        cursor = self.cnx.cursor()
+        cursor.execute(statement)
+        rows = cursor.fetchall()
+        cursor.close()
+        return [tuple(str(x) if x is not None else None for x in row) for row in rows]
+
+    def test_01_updates(self):
+        """Check per-row status, NULLs, date conversion, and that a failing row does not stop its batch"""
+        commentids, _ = resolve_commentids(self.cnx, LORISMAP, UPDATE_ROWS)
+        status = execute_instrument_updates(self.cnx, LORISMAP, UPDATE_ROWS, commentids, batch_size=10)
+        self.assertEqual(list(status["Update Status"]), ["updated", "unresolved", "failed", "duplicate"])
+        self.assertNotEqual(status.at[2, "Update Error"], "")
+        # c1 has data now, so importing it again is skipped
+        status = execute_instrument_updates(self.cnx, LORISMAP, UPDATE_ROWS[:1], commentids[:1])
+        self.assertEqual(list(status["Update Status"]), ["skipped"])
+        self.assertEqual(
+            self.select("SELECT CommentID, Date_taken, Data_entry_completion_status, examiner, score FROM vineland3 ORDER BY CommentID"),
+            [("DDE_c1", None, None, None, None), ("c1", "2021-05-26", "Complete", "54", "12"), ("c2", None, None, None, None), ("c3", None, None, None, None)],
+        )
+        self.assertEqual(
+            self.select("SELECT CommentID, Data_entry, Administration FROM flag WHERE Data_entry IS NOT NULL"),
+            [("c1", "Complete", "All")],
+        )
+
+    def test_02_dry_run(self):
+        """Check dry run rolls every update back"""
+        commentids, _ = resolve_commentids(self.cnx, LORISMAP, UPDATE_ROWS[:1])
+        status = execute_instrument_updates(self.cnx, LORISMAP, UPDATE_ROWS[:1], commentids, dry_run=True)
+        self.assertEqual(list(status["Update Status"]), ["dry-run"])
+        self.assertEqual(self.select("SELECT COUNT(*) FROM vineland3 WHERE Date_taken IS NOT NULL"), [("0",)])
+
+    def test_03_malformed_date(self):
+        """Check a row with a malformed date is reported as failed and not applied, and the other rows are"""
+        datarows = [dict(UPDATE_ROWS[2], Score="4"), dict(UPDATE_ROWS[0], DateTaken="2021-05-26")]
+        commentids, _ = resolve_commentids(self.cnx, LORISMAP, datarows)
+        status = execute_instrument_updates(self.cnx, LORISMAP, datarows, commentids)
+        self.assertEqual(list(status["Update Status"]), ["updated", "failed"])
+        self.assertIn("2021-05-26", status.at[1, "Update Error"])
+        self.assertEqual(self.select("SELECT CommentID FROM vineland3 WHERE Date_taken IS NOT NULL"), [("c3",)])
+
+
+@unittest.skipIf(
+    os.environ.get("LORIS_TEST_MARIADB") is None or importlib.util.find_spec("mysql") is None,
+    "set LORIS_TEST_MARIADB=host:port:user:password:database to test against MariaDB",
+)
+class TestExecuteInstrumentUpdatesMariaDB(TestExecuteInstrumentUpdates):
+    def connect(self):
+        import mysql.connector
+
+        host, port, user, password, database = os.environ["LORIS_TEST_MARIADB"].split(":")
+        cnx = mysql.connector.connect(host=host, port=int(port), user=user, password=password, database=database)
+        cursor = cnx.cursor()
+        for table in ["candidate", "session", "flag", "vineland3"]:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.close()
+        return loris_database(cnx)
+
+
+
+class TestStreamingImport(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.inputfile = os.path.join(self.tmpdir.name, "export.csv")
+        with open(self.inputfile, "w", newline="") as f:
+            writer = csv.DictWriter(f, list(UPDATE_ROWS[0].keys()))
+            writer.writeheader()
+            writer.writerows(UPDATE_ROWS)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_rows_and_chunks(self):
+        """Check rows, chunks and mapped records read from the csv"""
+        self.assertEqual(list(iter_import_data(self.inputfile)), UPDATE_ROWS)
+        chunks = list(iter_import_data(self.inputfile, chunksize=3))
+        self.assertEqual([list(chunk.index) for chunk in chunks], [[0, 1, 2], [3]])
+        records = list(iter_import_data(self.inputfile, lorismap=LORISMAP))
+        self.assertEqual(records[0]["candidate"], "AIS1001%")
+        self.assertEqual(records[3]["Date_taken"], None)
+
+    def test_02_import_pipeline(self):
+        """Check chunks go through CommentID resolution and the updates, keeping row numbers"""
+        cnx = loris_database()
+        results = list(import_data_export(cnx, cnx, LORISMAP, self.inputfile, chunksize=2))
+        self.assertEqual([list(chunk.index) for chunk in results], [[0, 1], [2, 3]])
+        self.assertEqual(
+            [status for chunk in results for status in chunk["Update Status"]],
+            ["updated", "unresolved", "failed", "skipped"],
+        )
+        cnx.close()
+
+    def test_03_duplicates_across_chunks(self):
+        """Check a CommentID repeated in a later chunk is a duplicate, wherever the chunk boundaries fall"""
+        with open(self.inputfile, "w", newline="") as f:
+            writer = csv.DictWriter(f, list(UPDATE_ROWS[0].keys()))
+            writer.writeheader()
+            writer.writerow({"ExamineeID": "AIS1001", "LastName": "agccx12m", "DateTaken": "", "Score": "5"})
+            writer.writerow({"ExamineeID": "AIS1001", "LastName": "agccx12m", "DateTaken": "", "Score": "7"})
+        for chunksize in [1, 2]:
+            cnx = loris_database()
+            results = list(import_data_export(cnx, cnx, LORISMAP, self.inputfile, chunksize=chunksize))
+            self.assertEqual([status for chunk in results for status in chunk["Update Status"]], ["updated", "duplicate"])
+            cursor = cnx.cursor()
+            cursor.execute("SELECT score FROM vineland3 WHERE CommentID = 'c1'")
+            self.assertEqual(cursor.fetchall(), [(5,)])
+            cnx.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import contextlib
+import io
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+
+import pandas as pd
+
+from mysql_helper import generate_insert_sql, bulk_insert_sql, generate_load_data_sql, instrument_table_columns
+
+# NOTE: from command line in LORIS_instrument_builder directory run: python -m unittest -v tests/test_mysql_helper.py
+
+
+def example_data(nrows=5):
+    return pd.DataFrame(
+        {
+            "CommentID": [f"comment{i}" for i in range(nrows)],
+            "q1": ["it's", 'say "hi"', "NA", None, "#N/A"][:nrows] + ["x"] * max(0, nrows - 5),
+            "q2": [1.5, None, 3.0, 4.25, 5.0][:nrows] + [6.0] * max(0, nrows - 5),
+        }
+    )
+
+
+class TestGenerateInsertSql(unittest.TestCase):
+    def test_01_stream_matches_template(self):
+        """Check streamed INSERT has the same values as the jinja2 template for string columns"""
+        data = example_data()[["CommentID", "q1"]].fillna("nan")
+        template_sql = generate_insert_sql("test_table", data)
+        stream_sql = generate_insert_sql("test_table", data, stream=True, chunksize=2)
+        self.assertEqual(re.sub(r"\s+", "", template_sql), re.sub(r"\s+", "", stream_sql))
+
+    def test_02_rows_per_statement(self):
+        """Check rows_per_statement splits output and statements_per_transaction adds COMMITs"""
+        sql = generate_insert_sql(
+            "test_table", example_data(7), rows_per_statement=3, statements_per_transaction=2
+        )
+        self.assertEqual(sql.count("INSERT INTO"), 3)
+        self.assertEqual(sql.count("START TRANSACTION;"), 2)
+        self.assertEqual(sql.count("COMMIT;"), 2)
+
+    def test_03_max_statement_bytes(self):
+        """Check no statement is larger than max_statement_bytes"""
+        sql = generate_insert_sql("test_table", example_data(50), max_statement_bytes=300)
+        statements = [x + ";\n" for x in sql.split(";\n") if x]
+        self.assertGreater(len(statements), 1)
+        for statement in statements:
+            self.assertLessEqual(len(statement.encode("utf-8")), 300)
+
+
+class TestBulkInsertSql(unittest.TestCase):
+    def setUp(self):
+        self.cnx = sqlite3.connect(":memory:")
+        self.cnx.execute("CREATE TABLE test_table (CommentID varchar(255), q1 varchar(255), q2 varchar(255))")
+
+    def tearDown(self):
+        self.cnx.close()
+
+    def test_01_insert_batches(self):
+        """Check every row is inserted when the data spans several batches"""
+        ninserted = bulk_insert_sql("test_table", example_data(23), connection=self.cnx, batch_size=5)
+        self.assertEqual(ninserted, 23)
+        self.assertEqual(self.cnx.execute("SELECT COUNT(*) FROM test_table").fetchone()[0], 23)
+
+    def test_02_null_values(self):
+        """Check NA strings and missing values are inserted as NULL"""
+        bulk_insert_sql("test_table", example_data(), connection=self.cnx)
+        rows = self.cnx.execute("SELECT q1, q2 FROM test_table ORDER BY CommentID").fetchall()
+        self.assertEqual(rows[0], ("it's", "1.5"))
+        self.assertEqual(rows[1], ('say "hi"', None))
+        self.assertEqual([row[0] for row in rows[2:]], [None, None, None])
+
+    def test_03_failed_batch_rolls_back(self):
+        """Check a failing batch is rolled back and earlier batches stay committed"""
+        data = example_data(10)
+        data.loc[7, "CommentID"] = None
+        self.cnx.execute("DROP TABLE test_table")
+        self.cnx.execute("CREATE TABLE test_table (CommentID varchar(255) NOT NULL, q1 varchar(255), q2 varchar(255))")
+        with self.assertRaisesRegex(RuntimeError, "rows 5 to 9"):
+            bulk_insert_sql("test_table", data, connection=self.cnx, batch_size=5, retry_wait=0)
+        self.assertEqual(self.cnx.execute("SELECT COUNT(*) FROM test_table").fetchone()[0], 5)
+
+
+class TestGenerateLoadDataSql(unittest.TestCase):
+    instrument_json = {
+        "instrument_name_sql": "test_table",
+        "fields": {
+            "field1": {"field_name_sql": "q_enum", "field_type_sql": "enum", "enum_values_sql": ["1", "2"], "page_php": 0},
+            "field2": {"field_name_sql": "q_date", "field_type_sql": "date", "page_php": 0},
+            "field3": {"field_name_sql": "q_text", "field_type_sql": "varchar(255)", "page_php": 0},
+        },
+    }
+
+    def test_01_tsv_and_statement(self):
+        """Check TSV escaping, NULLs, enum/date coercion and CREATE TABLE column order"""
+        data = pd.DataFrame(
+            {
+                "q_text": ["tab\there", "line\nbreak", None],
+                "extra": ["a", "b", "c"],
+                "q_date": ["05/26/2021", "not a date", None],
+                "q_enum": [1.0, 3.0, None],
+                "CommentID": ["c1", "c2", "c3"],
+            }
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_file = os.path.join(tmpdir, "load_test_table.sql")
+            generate_load_data_sql("test_table", data, output_file, instrument_json=self.instrument_json)
+            with open(output_file) as f:
+                statement = f.read()
+            with open(os.path.join(tmpdir, "load_test_table.tsv"), encoding="utf-8") as f:
+                lines = f.read().split("\n")
+
+        self.assertIn("(`CommentID`, `q_enum`, `q_date`, `q_text`);", statement)
+        self.assertEqual(lines[0], "CommentID\tq_enum\tq_date\tq_text")
+        self.assertEqual(lines[1], "c1\t1\t2021-05-26\ttab\\there")
+        self.assertEqual(lines[2], "c2\t\\N\t\\N\tline\\nbreak")
+        self.assertEqual(lines[3], "c3\t\\N\t\\N\t\\N")
+
+    def test_02_mixed_date_formats(self):
+        """Check dates in different formats are all loaded, and unparseable dates are reported"""
+        data = pd.DataFrame({"CommentID": ["c1", "c2", "c3"], "q_date": ["05/26/2021", "2021-05-27", "not a date"]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_file = os.path.join(tmpdir, "load_test_table.sql")
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                generate_load_data_sql("test_table", data, output_file, instrument_json=self.instrument_json)
+            with open(os.path.join(tmpdir, "load_test_table.tsv"), encoding="utf-8") as f:
+                lines = f.read().split("\n")
+
+        self.assertEqual([line.split("\t")[1] for line in lines[1:4]], ["2021-05-26", "2021-05-27", "\\N"])
+        self.assertIn("1 value(s) in column q_date are not dates", stdout.getvalue())
+
+    def test_03_enum_values_with_quotes(self):
+        """Check enum values with quotes, commas and parentheses are kept, and the fixed LORIS columns are typed"""
+        instrument_json = {
+            "instrument_name_sql": "test_table",
+            "fields": {
+                "field1": {"field_name_sql": "q_enum", "field_type_sql": "enum", "enum_values_sql": ["don't know", "yes (a, b)"], "page_php": 0},
+            },
+        }
+        columns = instrument_table_columns(instrument_json)
+        self.assertEqual(columns["q_enum"], {"type": "enum", "enum_values": ["don't know", "yes (a, b)", "not_answered"]})
+        self.assertEqual(columns["Date_taken"]["type"], "date")
+        data = pd.DataFrame({"CommentID": ["c1", "c2", "c3"], "q_enum": ["don't know", "yes (a, b)", "no"]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_file = os.path.join(tmpdir, "load_test_table.sql")
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_load_data_sql("test_table", data, output_file, instrument_json=instrument_json)
+            with open(os.path.join(tmpdir, "load_test_table.tsv"), encoding="utf-8") as f:
+                lines = f.read().split("\n")
+        self.assertEqual([line.split("\t")[1] for line in lines[1:4]], ["don't know", "yes (a, b)", "\\N"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import io
+import os
+import tempfile
+import zipfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pandas as pd
+
+import qualtrics
+from qualtrics import (
+    get_cached_qualtrics_survey_definition,
+    get_qualtrics_survey_responses,
+    load_sync_state,
+    qualtrics_recorded_date,
+    qualtrics_export_read_options,
+    save_sync_watermark,
+    save_synced_responses,
+    sync_qualtrics_survey_responses,
+)
+
+# NOTE: from command line in LORIS_instrument_builder directory run: python -m unittest -v tests/test_qualtrics.py
+
+
+def response_export(responses):
+    """Response export DataFrame like get_qualtrics_survey_responses, with the question text and ImportId header rows"""
+    rows = [["Response ID", "Recorded Date", "Q1"], ['{"ImportId":"_recordId"}', '{"ImportId":"recordedDate"}', '{"ImportId":"QID1"}']]
+    return pd.DataFrame(rows + [list(x) for x in responses], columns=["ResponseId", "RecordedDate", "Q1"])
+
+
+class TestSyncSurveyResponses(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.statefile = os.path.join(self.tmpdir.name, "state.json")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def sync(self, export):
+        with mock.patch.object(qualtrics, "get_qualtrics_survey_responses", return_value=export) as get:
+            df, watermark = sync_qualtrics_survey_responses("token", "dc", "SV_1", statefile=self.statefile)
+        return df, watermark, get.call_args.kwargs["startdate"]
+
+    def test_01_watermark_round_trip(self):
+        """Check the watermark is only saved by save_sync_watermark, and is the startDate of the next pull"""
+        df, watermark, startdate = self.sync(
+            response_export([("R_1", "2024-01-01 10:00:00", "a"), ("R_2", "2024-01-02 10:00:00", "b")])
+        )
+        self.assertIsNone(startdate)
+        self.assertEqual(list(df["ResponseId"])[2:], ["R_1", "R_2"])
+        self.assertEqual(watermark["RecordedDate"], "2024-01-02T10:00:00-06:00")
+        self.assertEqual(watermark["ResponseIds"], ["R_2"])
+        self.assertEqual(load_sync_state(self.statefile), {})
+
+        save_sync_watermark(self.statefile, "SV_1", watermark)
+        self.assertEqual(load_sync_state(self.statefile), {"SV_1": watermark})
+        _, _, startdate = self.sync(response_export([("R_2", "2024-01-02 10:00:00", "b")]))
+        self.assertEqual(startdate, "2024-01-02T10:00:00-06:00")
+
+    def test_02_boundary_dedupe(self):
+        """Check responses at the watermark time are dropped once synced, and new ones at the same time are added"""
+        save_sync_watermark(self.statefile, "SV_1", {"RecordedDate": "2024-01-02T10:00:00-06:00", "ResponseIds": ["R_2"]})
+        df, watermark, _ = self.sync(
+            response_export(
+                [("R_2", "2024-01-02 10:00:00", "b"), ("R_3", "2024-01-02 10:00:00", "c"), ("R_3", "2024-01-02 10:00:00", "c")]
+            )
+        )
+        self.assertEqual(list(df["ResponseId"]), ["Response ID", '{"ImportId":"_recordId"}', "R_3"])
+        self.assertEqual(watermark["ResponseIds"], ["R_2", "R_3"])
+        # nothing new
+        df, watermark, _ = self.sync(response_export([("R_2", "2024-01-02 10:00:00", "b")]))
+        self.assertEqual(len(df), 2)
+        self.assertIsNone(watermark)
+
+    def test_03_dst_localization(self):
+        """Check ambiguous fall-back times take the daylight offset and nonexistent spring-forward times are shifted"""
+        self.assertEqual(qualtrics_recorded_date(pd.Timestamp("2024-11-03 01:30:00")), "2024-11-03T01:30:00-05:00")
+        self.assertEqual(qualtrics_recorded_date(pd.Timestamp("2024-11-03 02:30:00")), "2024-11-03T02:30:00-06:00")
+        self.assertEqual(qualtrics_recorded_date(pd.Timestamp("2024-03-10 02:30:00")), "2024-03-10T03:00:00-05:00")
+        _, watermark, _ = self.sync(response_export([("R_1", "2024-11-03 01:30:00", "a")]))
+        self.assertEqual(watermark["RecordedDate"], "2024-11-03T01:30:00-05:00")
+
+    def test_04_rejected_options(self):
+        """Check chunksize and saveoutput are rejected, the dedupe needs the whole export"""
+        for option in ["chunksize", "saveoutput"]:
+            with self.assertRaises(ValueError):
+                sync_qualtrics_survey_responses("token", "dc", "SV_1", statefile=self.statefile, **{option: 10})
+
+    def test_05_save_synced_responses(self):
+        """Check the deduped responses are written in the export format, and nothing is written without responses"""
+        df = response_export([("R_3", "2024-01-02 10:00:00", "c, d")])
+        outputfile = save_synced_responses(df, "SV_1", "tsv", self.tmpdir.name)
+        pd.testing.assert_frame_equal(pd.read_csv(outputfile, encoding="UTF-16", **qualtrics_export_read_options("tsv")), df)
+        self.assertIsNone(save_synced_responses(response_export([]), "SV_1", "tsv", self.tmpdir.name))
+        self.assertEqual(os.listdir(self.tmpdir.name), [os.path.basename(outputfile)])
+
+
+class TestCachedSurveyDefinition(unittest.TestCase):
+    def test_01_parallel_first_run(self):
+        """Check workers creating the cache directory at the same time all cache their survey"""
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            qualtrics, "get_qualtrics_survey_last_modified", return_value="2024-01-01T00:00:00Z"
+        ), mock.patch.object(qualtrics, "get_qualtrics_survey_definition", side_effect=lambda token, dc, surveyid: {"id": surveyid}):
+            cachedir = os.path.join(tmpdir, "cache")
+            surveyids = [f"SV_{i}" for i in range(16)]
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                definitions = list(
+                    executor.map(lambda surveyid: get_cached_qualtrics_survey_definition("token", "dc", surveyid, cachedir=cachedir), surveyids)
+                )
+            self.assertEqual(definitions, [{"id": surveyid} for surveyid in surveyids])
+            self.assertEqual(len(os.listdir(cachedir)), 16)
+
+
+class FakeResponse:
+    """Stand-in for the requests responses used by get_qualtrics_survey_responses"""
+
+    def __init__(self, payload=None, content=b""):
+        self.payload, self.content = payload, content
+
+    def json(self):
+        return self.payload
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class TestReadResponseExport(unittest.TestCase):
+    def get_responses(self, text, fileformat, textencoding, **kwargs):
+        """Export `text` as a zipped response file, downloaded through the spooled temporary file"""
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as z:
+            z.writestr(f"Survey.{fileformat}", text.encode(textencoding))
+
+        def request(method, url, headers, data=None, stream=False):
+            return FakeResponse({"result": {"progressId": "ES_1"}}) if method == "POST" else FakeResponse(content=buffer.getvalue())
+
+        with mock.patch.object(qualtrics, "qualtrics_api_request", side_effect=request), mock.patch.object(
+            qualtrics, "wait_for_qualtrics_export", return_value={"result": {"status": "complete", "fileId": "F_1"}}
+        ), mock.patch.object(qualtrics, "QUALTRICS_DOWNLOAD_SPOOL_SIZE", 16):
+            return get_qualtrics_survey_responses("token", "dc", "SV_1", fileformat=fileformat, showprogress=False, **kwargs)
+
+    def test_01_utf16_default(self):
+        """Check exports are read as UTF-16 by default, like before, for tsv and csv"""
+        df = self.get_responses("ResponseId\tQ1\nR_1\tcafé\n", "tsv", "utf-16")
+        self.assertEqual(df.to_dict(orient="records"), [{"ResponseId": "R_1", "Q1": "café"}])
+        df = self.get_responses("ResponseId,Q1\nR_1,café\n", "csv", "utf-16")
+        self.assertEqual(df.to_dict(orient="records"), [{"ResponseId": "R_1", "Q1": "café"}])
+
+    def test_02_encoding_and_chunks(self):
+        """Check the encoding parameter, and chunks read from the spooled download"""
+        df = self.get_responses("ResponseId,Q1\nR_1,café\n", "csv", "utf-8-sig", encoding="utf-8-sig")
+        self.assertEqual(list(df.columns), ["ResponseId", "Q1"])
+        chunks = self.get_responses(
+            "ResponseId\tQ1\n" + "".join(f"R_{i}\tq{i}\n" for i in range(5)), "tsv", "utf-16", chunksize=2
+        )
+        self.assertEqual([list(chunk["ResponseId"]) for chunk in chunks], [["R_0", "R_1"], ["R_2", "R_3"], ["R_4"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+import redcap
+from redcap import (
+    DATA_DICTIONARY_COLUMNS,
+    all_metadata_to_instrument_jsons,
+    data_dictionary_to_instrument_jsons,
+    generate_filtered_data_dict,
+    metadata_to_dict,
+    read_data_dictionary,
+)
+
+# NOTE: from command line in LORIS_instrument_builder directory run: python -m unittest -v tests/test_redcap.py
+
+
+def synthetic_data_dictionary(nfields=5000, nforms=50):
+    """REDCap metadata with `nfields` fields spread over `nforms` forms, in the format returned by redcap.get_metadata"""
+    field_types = ["text", "radio", "dropdown", "yesno", "checkbox", "calc", "notes", "descriptive"]
+    validations = ["", "date_mdy", "integer", "number", "email"]
+    metadata = []
+    for i in range(nfields):
+        metadata.append(
+            {
+                "field_name": f"field_{i}",
+                # forms are contiguous blocks of fields, like a REDCap export
+                "form_name": f"form_{i * nforms // nfields}",
+                "field_type": field_types[i % len(field_types)],
+                "field_label": f"Question {i}",
+                "select_choices_or_calculations": "1, Yes | 0, No",
+                "text_validation_type_or_show_slider_number": validations[i % len(validations)],
+                "identifier": "y" if i % 97 == 0 else "",
+            }
+        )
+    return metadata
+
+
+class TestMetadataToDict(unittest.TestCase):
+    def test_01_filter(self):
+        """Check descriptive, notes, identifier and unvalidated text fields are excluded"""
+        include = generate_filtered_data_dict(synthetic_data_dictionary(nfields=400, nforms=4))
+        self.assertIsInstance(include, set)
+        self.assertNotIn("field_7", include)  # descriptive
+        self.assertNotIn("field_6", include)  # notes
+        self.assertNotIn("field_97", include)  # identifier
+        self.assertNotIn("field_0", include)  # text without validation
+        self.assertIn("field_16", include)  # text with integer validation
+        self.assertIn("field_1", include)  # radio
+
+    def test_02_form_order(self):
+        """Check forms and fields keep the data dictionary order"""
+        metadata = synthetic_data_dictionary(nfields=400, nforms=4)
+        include = generate_filtered_data_dict(metadata)
+        sorted_metadata = metadata_to_dict(metadata)
+        self.assertEqual(list(sorted_metadata), ["form_0", "form_1", "form_2", "form_3"])
+        self.assertEqual(
+            [field for form in sorted_metadata.values() for field in form],
+            [x["field_name"] for x in metadata if x["field_name"] in include],
+        )
+
+    def test_03_large_data_dictionary(self):
+        """Check a 5,000 field data dictionary is grouped in well under a second"""
+        metadata = synthetic_data_dictionary(nfields=5000, nforms=50)
+        start = time.perf_counter()
+        sorted_metadata = metadata_to_dict(metadata)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(sorted_metadata), 50)
+        self.assertLess(elapsed, 1.0, msg=f"metadata_to_dict took {elapsed:.2f}s for 5,000 fields")
+
+
+class TestDataDictionary(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.metadata = synthetic_data_dictionary(nfields=200, nforms=5)
+        # csv export with REDCap's column headers, and the json metadata export
+        self.csv_path = os.path.join(self.tmpdir.name, "data_dictionary.csv")
+        self.json_path = os.path.join(self.tmpdir.name, "data_dictionary.json")
+        api_to_csv = {value: key for key, value in DATA_DICTIONARY_COLUMNS.items()}
+        pd.DataFrame(self.metadata).rename(columns=api_to_csv).to_csv(self.csv_path, index=False)
+        with open(self.json_path, "w") as f:
+            json.dump(self.metadata, f)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_read_csv_and_json(self):
+        """Check csv and json data dictionaries are read in the same format as the API metadata"""
+        self.assertEqual(read_data_dictionary(self.csv_path), self.metadata)
+        self.assertEqual(read_data_dictionary(self.json_path), self.metadata)
+
+    def test_02_cached_instruments(self):
+        """Check instruments match the API conversion, and are read from the content hash cache the second time"""
+        cachedir = os.path.join(self.tmpdir.name, "cache")
+        expected = all_metadata_to_instrument_jsons(self.metadata)
+        self.assertEqual(data_dictionary_to_instrument_jsons(self.csv_path, cachedir), expected)
+        [cachefile] = os.listdir(cachedir)
+        with open(os.path.join(cachedir, cachefile), "w") as f:
+            json.dump(["cached"], f)
+        self.assertEqual(data_dictionary_to_instrument_jsons(self.csv_path, cachedir), ["cached"])
+        # a changed file is converted again
+        with open(self.csv_path, "a") as f:
+            f.write("extra_field,form_0,yesno,Extra,,,\n")
+        instruments = data_dictionary_to_instrument_jsons(self.csv_path, cachedir)
+        self.assertEqual(len(instruments), 5)
+        self.assertEqual(len(os.listdir(cachedir)), 2)
+
+    def test_03_cache_follows_conversion_code(self):
+        """Check instruments cached by a different version of the conversion code are not reused"""
+        cachedir = os.path.join(self.tmpdir.name, "cache")
+        expected = data_dictionary_to_instrument_jsons(self.csv_path, cachedir)
+        [cachefile] = os.listdir(cachedir)
+        with open(os.path.join(cachedir, cachefile), "w") as f:
+            json.dump(["cached"], f)
+        with mock.patch.object(redcap, "REDCAP_DICTIONARY_CACHE_VERSION", "older conversion code"):
+            self.assertEqual(data_dictionary_to_instrument_jsons(self.csv_path, cachedir), expected)
+        self.assertEqual(len(os.listdir(cachedir)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "E-Lab"))
+
+# NOTE: from command line in LORIS_instrument_builder directory run: python -m unittest -v tests/test_score_test_for_visit_all_candidates.py
+
+FAKE_SCORER = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_score_instrument.py")]
+
+
+class TestScoreCandidateList(unittest.TestCase):
+    def setUp(self):
+        from score_test_for_visit_all_candidates import score_test_for_candidate_list
+
+        self.score = score_test_for_candidate_list
+
+    def test_01_results_table(self):
+        """Check exit codes and stderr are recorded per candidate, in candidate list order"""
+        candidates = pd.DataFrame(
+            {"candidateID": ["300001", "fail300002", "300003"], "sessionID": [1, 2, 3]}
+        )
+        results = self.score("test_instrument", candidates, jobs=2, command=FAKE_SCORER)
+        self.assertEqual(list(results["candidateID"]), ["300001", "fail300002", "300003"])
+        self.assertEqual(list(results["returncode"]), [0, 1, 0])
+        self.assertEqual(list(results["status"]), ["scored", "failed", "scored"])
+        self.assertIn("no test_instrument instrument", results["stderr"][1])
+        self.assertIn("Scored test_instrument (one) for candidate 300001 session 1", results["stdout"][0])
+
+    def test_02_concurrent(self):
+        """Check slow candidates are scored at the same time, and a timeout is reported"""
+        candidates = pd.DataFrame({"candidateID": [f"slow{i}" for i in range(4)], "sessionID": range(4)})
+        start = time.perf_counter()
+        results = self.score("test_instrument", candidates, jobs=4, command=FAKE_SCORER)
+        self.assertLess(time.perf_counter() - start, 6)
+        self.assertTrue((results["status"] == "scored").all())
+
+        results = self.score("test_instrument", candidates[:1], command=FAKE_SCORER, timeout=0.5)
+        self.assertEqual(results["status"][0], "timeout")
+
+    def test_03_dry_run(self):
+        """Check dry run lists the commands without running them"""
+        candidates = pd.DataFrame({"candidateID": ["fail300002"], "sessionID": [2]})
+        results = self.score("test_instrument", candidates, command=["php", "score_instrument.php"], dry_run=True)
+        self.assertEqual(results["status"][0], "dry-run")
+        self.assertEqual(results["command"][0], "php score_instrument.php test_instrument one fail300002 2")
+
+    def test_04_dry_run_results_file(self):
+        """Check the results csv is written for a scoring run, and not for a dry run"""
+        import score_test_for_visit_all_candidates
+
+        candidates = pd.DataFrame({"candidateID": ["300001"], "sessionID": [1]})
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch.object(
+            score_test_for_visit_all_candidates, "get_list_candidateID_sessionID_for_visit", return_value=candidates
+        ):
+            results_file = os.path.join(tmpdir, "results.csv")
+            score_test_for_visit_all_candidates.get_visit_list_and_score_test(
+                "V1", "test_instrument", results_file=results_file, command=FAKE_SCORER, dry_run=True
+            )
+            self.assertFalse(os.path.exists(results_file))
+            score_test_for_visit_all_candidates.get_visit_list_and_score_test(
+                "V1", "test_instrument", results_file=results_file, command=FAKE_SCORER
+            )
+            self.assertEqual(list(pd.read_csv(results_file)["status"]), ["scored"])
+
+
+if __name__ == "__main__":
+    unittest.main()
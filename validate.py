@@ -109,3 +109,24 @@ def valid_config_parameter(config_file, section, parameter):
         return config.get(section, parameter)
     else: 
         raise NameError(f"Parameter {parameter} does not exist in section {section} in the config file {config_file}")
+
+
+def valid_config_section(config_file, section, prefix=None):
+    config = configparser.ConfigParser()
+    try:
+        with open(config_file) as f:
+            config.read_file(f)
+    except IOError:
+        raise FileNotFoundError(
+            f"Config file ({config_file}) not found. Add or rename file so {config_file} exists in directory."
+        )
+
+    # return every option in the section, optionally only those labels starting with `prefix` (e.g. "id_")
+    if config.has_section(section):
+        return {
+            option: config.get(section, option)
+            for option in config.options(section)
+            if prefix is None or option.startswith(prefix)
+        }
+    else:
+        raise NameError(f"Section {section} does not exist in the config file {config_file}")